@@ -0,0 +1,1041 @@
+# Offline benchmarks for the Mikasa bot
+import os
+import re
+import sys
+import json
+import time
+import random
+import signal
+import resource
+import subprocess
+import asyncio
+import logging
+import argparse
+import tempfile
+from typing import Optional
+from urllib.parse import parse_qs
+
+# Point the bot at the local stubs before it reads its configuration
+STUB_HOST = "127.0.0.1"
+STUB_PORT = int(os.getenv("STUB_PORT", "8765"))
+BOT_API_PORT = int(os.getenv("BOT_API_PORT", "8766"))
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8767"))
+os.environ.setdefault(
+    "POLLINATIONS_URL",
+    f"http://{STUB_HOST}:{STUB_PORT}/prompt/{{prompt}}?width={{width}}&height={{height}}&seed={{seed}}&model={{model}}"
+)
+os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+os.environ.setdefault("BOT_API_URL", f"http://{STUB_HOST}:{BOT_API_PORT}")
+os.environ.setdefault("WEBHOOK_URL", f"http://{STUB_HOST}:{WEBHOOK_PORT}")
+os.environ["PORT"] = str(WEBHOOK_PORT)
+
+# Keep benchmark caches out of the working tree
+BENCH_DIR = tempfile.mkdtemp(prefix="mikasa-bench-")
+os.environ.setdefault("IMAGE_CACHE_DIR", os.path.join(BENCH_DIR, "images"))
+os.environ.setdefault("FILE_ID_CACHE_PATH", os.path.join(BENCH_DIR, "file_ids.json"))
+os.environ.setdefault("SETTINGS_DB_PATH", os.path.join(BENCH_DIR, "settings.db"))
+os.environ.setdefault("JOB_JOURNAL_PATH", os.path.join(BENCH_DIR, "journal.db"))
+
+import httpx
+import mikasa
+
+# What every error reply starts with, before the user's name
+ERROR_PREFIXES = tuple(message.split("{user_name}")[0] for message in mikasa.ERROR_MESSAGES.values())
+
+# Per-request client logging drowns out the results
+for noisy in ("httpx", "apscheduler", "telegram.ext"):
+    logging.getLogger(noisy).setLevel(logging.WARNING)
+
+# Smallest valid JPEG-looking payload the stub hands back
+FAKE_JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 4096 + b"\xff\xd9"
+
+class StubHTTPServer:
+    """Minimal keep-alive HTTP/1.1 server, subclasses implement respond()."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._server = None
+        self._connections = set()
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._server.close()
+        await self._server.wait_closed()
+        # Let handlers the clients already hung up on finish instead of cancelling them
+        if self._connections:
+            await asyncio.wait(self._connections, timeout=1)
+
+    async def respond(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        raise NotImplementedError
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    name, sep, value = line.partition(":")
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+
+                status, content_type, payload = await self.respond(method, target, headers, body)
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+class StubPollinationsServer(StubHTTPServer):
+    """Imitates the Pollinations image endpoint.
+
+    Latency is the median of a log-normal distribution whose spread is
+    jitter (0 means fixed), and error_rate of the responses fail with a
+    503 or a 429 after the same delay.
+    """
+
+    def __init__(self, host: str = STUB_HOST, port: int = STUB_PORT, latency: float = 1.0,
+                 jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hits = 0
+        self.errors = 0
+        self.peak_in_flight = 0
+        self._in_flight = 0
+        self._random = random.Random(seed)
+
+    async def respond(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        self.hits += 1
+        self._in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self._in_flight)
+        delay = self.latency * self._random.lognormvariate(0, self.jitter) if self.jitter else self.latency
+        failed = self._random.random() < self.error_rate
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._in_flight -= 1
+        if failed:
+            self.errors += 1
+            return self._random.choice((503, 429)), "text/plain", b"Busy"
+        return 200, "image/jpeg", FAKE_JPEG
+
+class FakeBotAPI(StubHTTPServer):
+    """Answers the Bot API methods the bot uses and records when each arrived.
+
+    Updates pushed with push_update() are handed out through getUpdates
+    long polling. Every reply the user would see is also recorded in
+    outcomes as photo, album, error or text.
+    """
+
+    def __init__(self, host: str = STUB_HOST, port: int = BOT_API_PORT, poll_wait: float = 1.0,
+                 edit_latency: float = 0.0):
+        super().__init__(host, port)
+        self.poll_wait = poll_wait
+        self.edit_latency = edit_latency
+        self.calls = []
+        # (time, chat_id, outcome)
+        self.outcomes = []
+        # (chat_id, text) of every editMessageText
+        self.edited_texts = []
+        self._message_ids = 0
+        self._updates = []
+        self._arrived = asyncio.Event()
+
+    async def __aexit__(self, *exc_info):
+        # Release parked long polls so their handlers can finish
+        self._arrived.set()
+        await super().__aexit__(*exc_info)
+
+    def push_update(self, update: dict) -> None:
+        """Queue an update for the next getUpdates."""
+        self._updates.append(update)
+        self._arrived.set()
+
+    def _fields(self, headers: dict, body: bytes) -> dict:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("multipart/"):
+            match = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            return {"chat_id": match.group(1).decode()} if match else {}
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    async def _get_updates(self, offset: int, timeout: float) -> list:
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            # Long poll, capped so shutdown never waits on a parked request
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), min(timeout, self.poll_wait))
+            except asyncio.TimeoutError:
+                pass
+        return list(self._updates)
+
+    def _outcome(self, api_method: str, fields: dict) -> Optional[str]:
+        if api_method in ("sendPhoto", "editMessageMedia"):
+            return "photo"
+        if api_method == "sendMediaGroup":
+            return "album"
+        if api_method in ("sendMessage", "editMessageText"):
+            text = str(fields.get("text", ""))
+            if text.startswith(ERROR_PREFIXES):
+                return "error"
+            # Sent messages are status or menus on the way, edits are what the user reads
+            return "text" if api_method == "editMessageText" else None
+        return None
+
+    def _message(self, chat_id: int, photo: bool = False) -> dict:
+        self._message_ids += 1
+        message = {
+            "message_id": self._message_ids,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": "ok"
+        }
+        if photo:
+            message["photo"] = [{
+                "file_id": f"photo-{self._message_ids}",
+                "file_unique_id": f"unique-{self._message_ids}",
+                "width": 512,
+                "height": 512
+            }]
+        return message
+
+    async def respond(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        api_method = path.rsplit("/", 1)[-1]
+        fields = self._fields(headers, body)
+        chat_id = int(fields.get("chat_id") or 0)
+        now = time.perf_counter()
+        self.calls.append((now, api_method, chat_id))
+        outcome = self._outcome(api_method, fields)
+        if outcome:
+            self.outcomes.append((now, chat_id, outcome))
+
+        if api_method == "getUpdates":
+            result = await self._get_updates(int(fields.get("offset") or 0), float(fields.get("timeout") or 0))
+        elif api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Mikasa", "username": "mikasa_bench_bot"}
+        elif api_method in ("sendMessage", "editMessageText"):
+            if api_method == "editMessageText":
+                self.edited_texts.append((chat_id, str(fields.get("text", ""))))
+                await asyncio.sleep(self.edit_latency)
+            result = self._message(chat_id)
+        elif api_method in ("sendPhoto", "editMessageMedia"):
+            result = self._message(chat_id, photo=True)
+        elif api_method == "sendMediaGroup":
+            photos = len(re.findall(rb'"type": ?"photo"', body))
+            result = [self._message(chat_id, photo=True) for _ in range(photos)]
+        else:
+            result = True
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+async def bench_concurrency(args) -> bool:
+    """Fire N generations at once and check they overlap instead of queueing."""
+    async with StubPollinationsServer(latency=args.latency) as stub:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            mikasa.generate_image_pollinations(mikasa.PromptSpec(f"benchmark prompt {i}"))
+            for i in range(args.requests)
+        ))
+        elapsed = time.perf_counter() - start
+        await mikasa.close_http_client()
+
+    ok = sum(1 for r in results if r)
+    serial = args.requests * args.latency
+    print(f"requests:          {args.requests}")
+    print(f"succeeded:         {ok}")
+    print(f"upstream hits:     {stub.hits}")
+    print(f"peak in flight:    {stub.peak_in_flight}")
+    print(f"elapsed:           {elapsed:.2f}s (serial would be {serial:.2f}s)")
+
+    # Overlapping generations finish in roughly one upstream latency
+    return ok == args.requests and elapsed < serial / 2
+
+async def bench_coalesce(args) -> bool:
+    """Fire N identical requests at once and check only one reaches upstream."""
+    # Whitespace and case differences must not defeat coalescing
+    spellings = ["identical benchmark prompt", "Identical  Benchmark Prompt", " identical benchmark PROMPT "]
+
+    async with StubPollinationsServer(latency=args.latency) as stub:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            mikasa.fetch_image(mikasa.PromptSpec(spellings[user_id % len(spellings)]), user_id, -100)
+            for user_id in range(args.requests)
+        ))
+        elapsed = time.perf_counter() - start
+        await mikasa.close_http_client()
+
+    images = {image_bytes for _, _, image_bytes in results}
+    flights = mikasa.image_flights.stats()
+    print(f"requests:          {args.requests}")
+    print(f"upstream hits:     {stub.hits}")
+    print(f"coalesced:         {flights['coalesced']}")
+    print(f"distinct results:  {len(images)}")
+    print(f"elapsed:           {elapsed:.2f}s")
+
+    return stub.hits == 1 and images == {FAKE_JPEG}
+
+def recorded_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Build a private-chat text update the way Telegram delivers it."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "text": text
+        }
+    }
+
+async def bench_webhook(args) -> bool:
+    """POST recorded updates to the webhook server and time them until the photo lands."""
+    application = mikasa.build_application()
+    stop_event = asyncio.Event()
+
+    async with StubPollinationsServer(latency=args.latency) as stub, FakeBotAPI() as bot_api:
+        server_task = asyncio.create_task(mikasa.serve_webhook(application, stop_event))
+        await asyncio.sleep(0.5)
+
+        sent_at = {}
+        async with httpx.AsyncClient(base_url=f"http://{STUB_HOST}:{WEBHOOK_PORT}") as client:
+            forbidden = await client.post(mikasa.WEBHOOK_CONFIG["path"], json=recorded_update(0, 1, "x"))
+
+            async def post(i: int) -> int:
+                chat_id = 1000 + i
+                sent_at[chat_id] = time.perf_counter()
+                response = await client.post(
+                    mikasa.WEBHOOK_CONFIG["path"],
+                    json=recorded_update(i + 1, chat_id, f"webhook benchmark prompt {i}"),
+                    headers={"X-Telegram-Bot-Api-Secret-Token": mikasa.WEBHOOK_CONFIG["secret"]}
+                )
+                return response.status_code
+
+            statuses = await asyncio.gather(*(post(i) for i in range(args.requests)))
+
+            # Wait for every photo to be delivered
+            deadline = time.perf_counter() + args.latency + 30
+            while time.perf_counter() < deadline:
+                delivered = {chat for _, method, chat in bot_api.calls if method == "editMessageMedia"}
+                if delivered >= set(sent_at):
+                    break
+                await asyncio.sleep(0.05)
+
+        stop_event.set()
+        await server_task
+
+    latencies = []
+    for at, method, chat_id in bot_api.calls:
+        if method == "editMessageMedia" and chat_id in sent_at:
+            latencies.append(at - sent_at.pop(chat_id))
+
+    print(f"updates posted:    {args.requests}")
+    print(f"bad secret status: {forbidden.status_code}")
+    print(f"photos delivered:  {len(latencies)}")
+    print(f"upstream hits:     {stub.hits}")
+    print(f"latency p50:       {percentile(latencies, 0.50) * 1000:.1f}ms")
+    print(f"latency p95:       {percentile(latencies, 0.95) * 1000:.1f}ms")
+    print(f"latency max:       {max(latencies, default=0) * 1000:.1f}ms")
+
+    return (
+        forbidden.status_code == 403
+        and all(status == 200 for status in statuses)
+        and len(latencies) == args.requests
+    )
+
+async def bench_variants(args) -> bool:
+    """Generate N four-variant albums and count the Bot API calls each one costs."""
+    count = mikasa.VARIANT_CONFIG["sample_album"]
+
+    async with StubPollinationsServer(latency=args.latency) as stub, FakeBotAPI() as bot_api:
+        async with mikasa.Bot(mikasa.BOT_TOKEN, base_url=f"{mikasa.BOT_API_URL}/bot") as bot:
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                mikasa.run_generation_job(bot, {
+                    "chat_id": 2000 + i,
+                    "status_message_id": 1,
+                    "user_id": 2000 + i,
+                    "mention": "Bench",
+                    "prompt": f"variant benchmark prompt {i}",
+                    "caption_key": "image_generated",
+                    "created_at": time.time(),
+                    "variants": count
+                })
+                for i in range(args.requests)
+            ))
+            elapsed = time.perf_counter() - start
+        await mikasa.close_http_client()
+
+    albums = [call for call in bot_api.calls if call[1] == "sendMediaGroup"]
+    delivery_calls = [call for call in bot_api.calls if call[1] in ("sendMediaGroup", "editMessageMedia")]
+    print(f"albums requested:  {args.requests} x {count} variants")
+    print(f"upstream hits:     {stub.hits}")
+    print(f"albums sent:       {len(albums)}")
+    print(f"delivery calls:    {len(delivery_calls)} (one edit per image would be {args.requests * count})")
+    print(f"elapsed:           {elapsed:.2f}s")
+
+    return stub.hits == args.requests * count and len(delivery_calls) == args.requests
+
+async def bench_priority(args) -> bool:
+    """Saturate the scheduler with samples, then check direct prompts still go first."""
+    scheduler = mikasa.generation_scheduler
+    scheduler.global_limit = 4
+    # Small enough that the direct prompts fill it and have to shed queued samples
+    scheduler.max_queue = args.requests + args.requests // 2
+    latencies = {"private": [], "sample": []}
+    shed = 0
+
+    async def request(i: int, priority: str) -> None:
+        nonlocal shed
+        start = time.perf_counter()
+        try:
+            await mikasa.fetch_image(mikasa.PromptSpec(f"{priority} priority prompt {i}"), 3000 + i, 3000 + i, priority)
+        except mikasa.SchedulerBusy:
+            shed += 1
+            return
+        latencies[priority].append(time.perf_counter() - start)
+
+    async with StubPollinationsServer(latency=args.latency) as stub:
+        samples = [asyncio.create_task(request(i, "sample")) for i in range(args.requests * 4)]
+        await asyncio.sleep(args.latency / 2)
+        direct = [asyncio.create_task(request(args.requests * 4 + i, "private")) for i in range(args.requests)]
+        await asyncio.gather(*samples, *direct)
+        await mikasa.close_http_client()
+
+    # A shed waiter cancelled before it resumes must not give back a slot it never held
+    tight = mikasa.GenerationScheduler(1, 2, 4, 1, queue_share=mikasa.SCHEDULER_CONFIG["queue_share"])
+    release = asyncio.Event()
+
+    async def hold(user_id: int, priority: str) -> None:
+        async with tight.slot(user_id, user_id, priority):
+            await release.wait()
+
+    holder = asyncio.create_task(hold(1, "generate"))
+    await asyncio.sleep(0)
+    shed_waiter = asyncio.create_task(hold(2, "sample"))
+    await asyncio.sleep(0)
+    direct_waiter = asyncio.create_task(hold(3, "private"))
+    await asyncio.sleep(0)
+    shed_waiter.cancel()
+    release.set()
+    await asyncio.gather(holder, shed_waiter, direct_waiter, return_exceptions=True)
+    cancelled_shed = tight.stats()["active"]
+
+    stats = scheduler.stats()
+    for priority, waits in latencies.items():
+        print(f"{priority:>8} p50 {percentile(waits, 0.50):.2f}s p95 {percentile(waits, 0.95):.2f}s "
+              f"({len(waits)} done, {stats[f'{priority}_shed'] + stats[f'{priority}_rejected']} shed)")
+    print(f"upstream hits:     {stub.hits}")
+    print(f"cancelled shed:    {cancelled_shed} slots held after")
+
+    # Direct prompts should wait for at most a couple of upstream rounds
+    return (
+        len(latencies["private"]) == args.requests
+        and cancelled_shed == 0
+        and stats["sample_shed"] > 0
+        and stats["private_shed"] + stats["private_rejected"] == 0
+        and percentile(latencies["private"], 0.95) < percentile(latencies["sample"], 0.95)
+    )
+
+async def bench_prewarm(args) -> bool:
+    """Fill the sample pool from idle capacity and time samples served from it."""
+    pool = mikasa.prewarm_pool
+    settings = mikasa.UserSettings()
+
+    async with StubPollinationsServer(latency=args.latency) as stub:
+        # A saturated scheduler must not be touched
+        limit = mikasa.generation_scheduler.global_limit
+        mikasa.generation_scheduler.global_limit = 0
+        await pool.refill()
+        busy_hits = stub.hits
+        mikasa.generation_scheduler.global_limit = limit
+        pool._skip_ticks = 0
+
+        # Each tick starts at most one batch, within the per-user slot cap
+        start = time.perf_counter()
+        ticks = 0
+        while pool.stats()["ready"] < pool.sample_pool and ticks < pool.sample_pool:
+            await pool.refill()
+            ticks += 1
+        fill_time = time.perf_counter() - start
+        prewarmed_hits = stub.hits
+
+        latencies = []
+        for i in range(args.requests):
+            start = time.perf_counter()
+            prompt = pool.pick_sample(settings)
+            await mikasa.fetch_image(mikasa.PromptSpec.from_settings(prompt, settings), 4000 + i, 4000 + i, "sample")
+            latencies.append(time.perf_counter() - start)
+        await mikasa.close_http_client()
+
+    served = latencies[:pool.sample_pool]
+    print(f"upstream while busy: {busy_hits}")
+    print(f"pool filled:       {prewarmed_hits} images in {ticks} ticks, {fill_time:.2f}s")
+    print(f"pool hits:         {pool.counters['hits']} of {args.requests} samples")
+    print(f"prewarmed p50:     {percentile(served, 0.50) * 1000:.1f}ms")
+    print(f"live sample p50:   {percentile(latencies[pool.sample_pool:], 0.50) * 1000:.1f}ms")
+
+    return busy_hits == 0 and prewarmed_hits == pool.sample_pool and percentile(served, 0.95) < args.latency / 4
+
+async def bench_drain(args) -> bool:
+    """Stop mid-generation, then check a restart finishes the journaled jobs in place."""
+    mikasa.inflight_jobs.deadline = args.latency / 4
+    headers = {"X-Telegram-Bot-Api-Secret-Token": mikasa.WEBHOOK_CONFIG["secret"]}
+    chats = {5000 + i for i in range(args.requests)}
+
+    async with StubPollinationsServer(latency=args.latency) as stub, FakeBotAPI() as bot_api:
+        stop_event = asyncio.Event()
+        server_task = asyncio.create_task(mikasa.serve_webhook(mikasa.build_application(), stop_event))
+        await asyncio.sleep(0.5)
+        async with httpx.AsyncClient(base_url=f"http://{STUB_HOST}:{WEBHOOK_PORT}") as client:
+            await asyncio.gather(*(
+                client.post(
+                    mikasa.WEBHOOK_CONFIG["path"],
+                    json=recorded_update(chat_id, chat_id, f"drain benchmark prompt {chat_id}"),
+                    headers=headers
+                )
+                for chat_id in chats
+            ))
+        await asyncio.sleep(args.latency / 4)
+
+        start = time.perf_counter()
+        stop_event.set()
+        # Mid-drain the replica stays live, leaves rotation and refuses new updates
+        await asyncio.sleep(0.05)
+        async with httpx.AsyncClient(base_url=f"http://{STUB_HOST}:{WEBHOOK_PORT}") as client:
+            draining = [
+                (await client.get("/healthz")).status_code,
+                (await client.get("/readyz")).status_code,
+                (await client.post(
+                    mikasa.WEBHOOK_CONFIG["path"], json=recorded_update(1, 1, "late prompt"), headers=headers
+                )).status_code
+            ]
+        await server_task
+        shutdown_time = time.perf_counter() - start
+        journaled = len(await mikasa.inflight_jobs.journal.pending())
+
+        # Restart: journaled jobs resume and edit the status messages they left behind
+        status_ids = {chat: i for _, method, chat in bot_api.calls if method == "sendMessage" for i in [chat]}
+        stop_event = asyncio.Event()
+        server_task = asyncio.create_task(mikasa.serve_webhook(mikasa.build_application(), stop_event))
+        deadline = time.perf_counter() + args.latency * 3 + 10
+        while time.perf_counter() < deadline:
+            delivered = {chat for _, method, chat in bot_api.calls if method == "editMessageMedia"}
+            if delivered >= chats:
+                break
+            await asyncio.sleep(0.05)
+        stop_event.set()
+        await server_task
+
+    remaining = len(await mikasa.inflight_jobs.journal.pending())
+    print(f"generations cut:   {journaled} of {len(chats)}")
+    print(f"shutdown time:     {shutdown_time:.2f}s (deadline {mikasa.inflight_jobs.deadline:.2f}s)")
+    print(f"while draining:    healthz {draining[0]}, readyz {draining[1]}, webhook {draining[2]}")
+    print(f"status messages:   {len(status_ids)} sent before shutdown")
+    print(f"resumed delivered: {len(delivered & chats)}")
+    print(f"upstream hits:     {stub.hits}")
+    print(f"journal after:     {remaining}")
+
+    return (
+        journaled == len(chats)
+        and delivered >= chats
+        and remaining == 0
+        and draining == [200, 503, 503]
+    )
+
+# Size presets offered by size_options_menu
+SIZE_PRESETS = [(512, 512), (768, 768), (1024, 1024), (1024, 768), (512, 768), (768, 512)]
+
+async def bench_health(args) -> bool:
+    """Probe liveness behind a stalled client and check readiness tracks queue saturation."""
+    scheduler = mikasa.generation_scheduler
+    scheduler.global_limit = 2
+    scheduler.max_queue = args.requests
+    server = mikasa.make_http_server()
+    mikasa.loop_monitor.start()
+    await server.start()
+
+    async with StubPollinationsServer(latency=args.latency) as stub, \
+            httpx.AsyncClient(base_url=f"http://{STUB_HOST}:{WEBHOOK_PORT}") as client:
+        # A client that never finishes its request must not hold up anyone else
+        _, stalled = await asyncio.open_connection(STUB_HOST, WEBHOOK_PORT)
+        stalled.write(b"GET /healthz HTTP/1.1\r\n")
+        await stalled.drain()
+
+        probes = []
+        for _ in range(20):
+            start = time.perf_counter()
+            live = await client.get("/healthz")
+            probes.append(time.perf_counter() - start)
+        idle = await client.get("/readyz")
+
+        # Malformed Content-Length headers get a 400 rather than killing the connection handler
+        malformed = []
+        for declared in (b"abc", b"-5", b"1e3"):
+            reader, writer = await asyncio.open_connection(STUB_HOST, WEBHOOK_PORT)
+            writer.write(b"POST /healthz HTTP/1.1\r\nContent-Length: " + declared + b"\r\n\r\n")
+            await writer.drain()
+            response = await reader.read()
+            malformed.append(response.split(b" ", 2)[1].decode() if response else "closed")
+            writer.close()
+
+        async def request(i: int) -> None:
+            try:
+                await mikasa.fetch_image(mikasa.PromptSpec(f"health benchmark prompt {i}"), 4000 + i, 4000 + i)
+            except mikasa.SchedulerBusy:
+                pass
+
+        tasks = [asyncio.create_task(request(i)) for i in range(args.requests + 2)]
+        await asyncio.sleep(0.2)
+        saturated = await client.get("/readyz")
+        await asyncio.gather(*tasks)
+        recovered = await client.get("/readyz")
+
+        stalled.close()
+        await mikasa.close_http_client()
+
+    await server.stop()
+    await mikasa.loop_monitor.stop()
+
+    print(f"liveness p50:      {percentile(probes, 0.50) * 1000:.1f}ms")
+    print(f"liveness max:      {max(probes) * 1000:.1f}ms")
+    print(f"ready when idle:   {idle.status_code}")
+    print(f"bad length:        {', '.join(malformed)}")
+    print(f"ready when full:   {saturated.status_code} {saturated.json()['checks']}")
+    print(f"ready after drain: {recovered.status_code}")
+    print(f"upstream hits:     {stub.hits}")
+
+    return (
+        live.status_code == 200
+        and max(probes) < 0.5
+        and idle.status_code == 200
+        and malformed == ["400"] * 3
+        and saturated.status_code == 503
+        and recovered.status_code == 200
+    )
+
+async def bench_watchdog(args) -> bool:
+    """Block the loop from inside a handler and check the watchdog names it with a stack."""
+    monitor = mikasa.loop_monitor
+    monitor.profile_path = os.path.join(BENCH_DIR, "profile.folded")
+    monitor.start()
+
+    @mikasa.timed_handler
+    async def blocking_handler(update, context) -> None:
+        # The kind of call that slipped into handlers unnoticed
+        time.sleep(args.latency)
+
+    @mikasa.timed_handler
+    async def healthy_handler(update, context) -> None:
+        await asyncio.sleep(0.01)
+
+    await asyncio.sleep(0.2)
+    await asyncio.gather(*(healthy_handler(None, None) for _ in range(args.requests)))
+    start = time.perf_counter()
+    await blocking_handler(None, None)
+    blocked = time.perf_counter() - start
+    await asyncio.sleep(monitor.interval * 2)
+    await monitor.stop()
+
+    handler, stack = monitor.last_stall or ("", "")
+    with open(monitor.profile_path) as f:
+        folded = f.read()
+    metrics = mikasa.render_metrics()
+
+    print(f"loop blocked:      {blocked:.2f}s")
+    print(f"stalls caught:     {monitor.stalls}")
+    print(f"blamed handler:    {handler}")
+    print(f"worst lag:         {monitor.max_lag:.2f}s")
+    print(f"profile stacks:    {len(folded.splitlines())}")
+
+    return (
+        handler == "blocking_handler"
+        and "time.sleep" in stack
+        and "blocking_handler" in folded
+        and 'mikasa_handler_seconds_count{handler="healthy_handler"} %d' % args.requests in metrics
+        and 'mikasa_loop_stalls_total{handler="blocking_handler"} 1' in metrics
+    )
+
+# Synthetic traffic for the replay benchmark, and which outcomes finish each kind
+TRAFFIC_MIX = "private=5,group=3,menu=1,sample=1"
+FINAL_OUTCOMES = {
+    "private": {"photo", "error"},
+    "group": {"photo", "error"},
+    "sample": {"photo", "error"},
+    "menu": {"text", "error"}
+}
+MENU_CLICKS = ("select_model", "settings_menu", "help_menu", "style_presets", "size_options", "back_to_generate")
+
+def group_update(update_id: int, chat_id: int, user_id: int, text: str) -> dict:
+    """Build a group text update from a member who is not the bot."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text
+        }
+    }
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    """Build a button click on one of the bot's private-chat messages."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(chat_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+                "text": "menu"
+            }
+        }
+    }
+
+def synthetic_event(kind: str, i: int, rng: random.Random) -> tuple:
+    """Return (chat_id, update) for the i-th event of a kind."""
+    if kind == "private":
+        chat_id = 10000 + i
+        return chat_id, recorded_update(i + 1, chat_id, f"replay prompt {i} {rng.choice(mikasa.RANDOM_PROMPTS)}")
+    if kind == "group":
+        chat_id = -(10000 + i)
+        return chat_id, group_update(i + 1, chat_id, 20000 + i, f"Mikasa replay group prompt {i}")
+    chat_id = 30000 + i
+    data = "sample" if kind == "sample" else rng.choice(MENU_CLICKS)
+    return chat_id, callback_update(i + 1, chat_id, data)
+
+def parse_mix(spec: str) -> dict:
+    """Parse kind=weight pairs, e.g. private=5,group=3."""
+    mix = {}
+    for pair in spec.split(","):
+        kind, _, weight = pair.partition("=")
+        if kind.strip() not in FINAL_OUTCOMES:
+            raise ValueError(f"Unknown traffic kind {kind!r}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def current_rss() -> int:
+    """Return resident memory in bytes."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+async def bench_replay(args) -> bool:
+    """Replay a traffic mix through the real Application over long polling, end to end."""
+    mix = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    application = mikasa.build_application()
+    stop_event = asyncio.Event()
+    rss_start = current_rss()
+    # chat_id -> (kind, pushed at)
+    pushed = {}
+    finished = {}
+
+    stub = StubPollinationsServer(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed
+    )
+    async with stub, FakeBotAPI() as bot_api:
+        server_task = asyncio.create_task(mikasa.serve_polling(application, stop_event))
+        await asyncio.sleep(0.5)
+
+        # Open-loop Poisson arrivals, the bot does not get to slow the sender down
+        started = time.perf_counter()
+        for i in range(args.requests):
+            kind = rng.choices(list(mix), weights=list(mix.values()))[0]
+            chat_id, update = synthetic_event(kind, i, rng)
+            pushed[chat_id] = (kind, time.perf_counter())
+            bot_api.push_update(update)
+            await asyncio.sleep(rng.expovariate(args.rate))
+
+        deadline = time.perf_counter() + args.latency * 10 + 30
+        seen = 0
+        while len(finished) < len(pushed) and time.perf_counter() < deadline:
+            for at, chat_id, outcome in bot_api.outcomes[seen:]:
+                if chat_id in pushed and chat_id not in finished and outcome in FINAL_OUTCOMES[pushed[chat_id][0]]:
+                    finished[chat_id] = (at, outcome)
+            seen = len(bot_api.outcomes)
+            await asyncio.sleep(0.05)
+        elapsed = max((at for at, _ in finished.values()), default=started) - started
+        rss_end = current_rss()
+
+        stop_event.set()
+        await server_task
+
+    latencies = {kind: [] for kind in mix}
+    errors = 0
+    for chat_id, (at, outcome) in finished.items():
+        kind, sent = pushed[chat_id]
+        latencies[kind].append(at - sent)
+        errors += outcome == "error"
+    overall = [latency for samples in latencies.values() for latency in samples]
+    bot_calls = sum(1 for _, method, _ in bot_api.calls if method != "getUpdates")
+
+    print(f"events:            {len(pushed)} at {args.rate:g}/s ({args.mix})")
+    print(f"finished:          {len(finished)} ({errors} as errors)")
+    print(f"throughput:        {len(finished) / elapsed if elapsed else 0:.1f} events/s")
+    for kind, samples in {**latencies, "all": overall}.items():
+        print(f"{kind:>8} p50 {percentile(samples, 0.50):.2f}s p95 {percentile(samples, 0.95):.2f}s "
+              f"p99 {percentile(samples, 0.99):.2f}s ({len(samples)})")
+    print(f"upstream hits:     {stub.hits} ({stub.errors} failed)")
+    print(f"bot api calls:     {bot_calls} ({bot_calls / max(len(pushed), 1):.1f} per event)")
+    print(f"rss:               {rss_start / 2**20:.1f}MB -> {rss_end / 2**20:.1f}MB, "
+          f"peak {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB")
+
+    return (
+        len(finished) == len(pushed)
+        and (errors == 0 or args.error_rate > 0)
+        and (not args.max_p95 or percentile(overall, 0.95) <= args.max_p95)
+    )
+
+async def bench_progress(args) -> bool:
+    """Queue slow generations and check progress edits stay sparse and never land after the photo."""
+    scheduler = mikasa.generation_scheduler
+    scheduler.global_limit = 2
+    # Results land while the first progress edit is still in flight
+    latency = mikasa.PROGRESS_CONFIG["first_delay"] + 0.1
+    jobs = max(args.requests // 4, 3)
+    application = mikasa.build_application()
+    stop_event = asyncio.Event()
+    pushed = {}
+
+    # Slow edits keep a progress edit in flight when results arrive
+    async with StubPollinationsServer(latency=latency) as stub, FakeBotAPI(edit_latency=0.3) as bot_api:
+        server_task = asyncio.create_task(mikasa.serve_polling(application, stop_event))
+        await asyncio.sleep(0.5)
+
+        started = time.perf_counter()
+        for i in range(jobs):
+            chat_id = 5000 + i
+            pushed[chat_id] = time.perf_counter()
+            bot_api.push_update(recorded_update(i + 1, chat_id, f"progress benchmark prompt {i}"))
+
+        deadline = started + latency * (jobs / 2 + 2) + 30
+        while time.perf_counter() < deadline:
+            delivered = {chat for _, chat, outcome in bot_api.outcomes if outcome == "photo"}
+            if delivered >= set(pushed):
+                break
+            await asyncio.sleep(0.1)
+        await asyncio.sleep(1)
+
+        stop_event.set()
+        await server_task
+
+    edits = {chat_id: [] for chat_id in pushed}
+    photos = {}
+    for at, method, chat_id in bot_api.calls:
+        if chat_id in pushed and method == "editMessageText":
+            edits[chat_id].append(at)
+        elif chat_id in pushed and method == "editMessageMedia":
+            photos[chat_id] = at
+    queued_texts = sum(1 for chat_id, text in bot_api.edited_texts if chat_id in pushed and "in line" in text)
+    # The first two jobs get a slot straight away and must never report a queue position
+    misplaced = sum(1 for chat_id, text in bot_api.edited_texts if chat_id in (5000, 5001) and "in line" in text)
+    # An edit must have been answered before the photo replaced the message
+    overtaken = sum(
+        1 for chat_id, at in photos.items()
+        if any(edit <= at < edit + bot_api.edit_latency for edit in edits[chat_id])
+    )
+    late = sum(1 for chat_id, at in photos.items() if any(edit > at for edit in edits[chat_id]))
+    counts = [len(edits[chat_id]) for chat_id in pushed]
+    elapsed = max(photos.values(), default=started) - started
+
+    print(f"generations:       {jobs} at {latency:.1f}s upstream, 2 at a time")
+    print(f"photos delivered:  {len(photos)} in {elapsed:.1f}s")
+    print(f"progress edits:    {sum(counts)} (max {max(counts)} per job, {queued_texts} with queue position)")
+    print(f"edits after photo: {late}")
+    print(f"photo overtook:    {overtaken}")
+    print(f"running in line:   {misplaced}")
+    print(f"upstream hits:     {stub.hits}")
+
+    # One edit per first_delay at most, backing off after that
+    bound = elapsed / mikasa.PROGRESS_CONFIG["first_delay"] + 1
+    return (
+        len(photos) == jobs
+        and late == 0
+        and overtaken == 0
+        and queued_texts > 0
+        and misplaced == 0
+        and max(counts) <= bound
+    )
+
+async def bench_boot(args) -> bool:
+    """Time a cold import and a fresh bot process from spawn to its first handled update."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    # Cached bytecode is what a dyno boots from after the first run
+    env = {**os.environ, "PYTHONDONTWRITEBYTECODE": "", "WEBHOOK_URL": "", "MIKASA_ROLE": "all"}
+    probe = "import time; started = time.perf_counter(); import mikasa; print(time.perf_counter() - started)"
+
+    imports = []
+    for _ in range(6):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", probe, cwd=root, env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+        imports.append(float(stdout))
+    imports = imports[1:]
+
+    async with FakeBotAPI() as bot_api:
+        # Waiting for the bot before it even starts, like an update sent during a deploy
+        update = recorded_update(1, 7000, "/ping")
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": 5}]
+        bot_api.push_update(update)
+        spawned = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "mikasa", cwd=root, env=env,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+
+        log = []
+
+        async def read_log() -> None:
+            async for line in process.stderr:
+                log.append(line.decode(errors="replace"))
+
+        reader = asyncio.create_task(read_log())
+        deadline = spawned + 30
+        replied = commands = None
+        while time.perf_counter() < deadline and replied is None:
+            for at, method, chat_id in bot_api.calls:
+                if method == "sendMessage" and chat_id == 7000:
+                    replied = at - spawned
+            await asyncio.sleep(0.01)
+        for at, method, _ in bot_api.calls:
+            if method == "setMyCommands" and commands is None:
+                commands = at - spawned
+
+        await asyncio.sleep(0.5)
+        process.send_signal(signal.SIGTERM)
+        await process.wait()
+        await reader
+
+    stages = {}
+    for line in log:
+        match = re.search(r"Boot stage (\w+) reached ([\d.]+)s", line)
+        if match:
+            stages[match.group(1)] = float(match.group(2))
+
+    print(f"import mikasa:     p50 {percentile(imports, 0.5) * 1000:.0f}ms max {max(imports) * 1000:.0f}ms")
+    for stage, seconds in stages.items():
+        print(f"{stage + ':':<18} {seconds:.2f}s after process start (reported)")
+    print(f"commands set:      {commands:.2f}s after spawn" if commands is not None else "commands set:      never")
+    print(f"first reply:       {replied:.2f}s after spawn" if replied is not None else "first reply:       never")
+    print(f"exit code:         {process.returncode}")
+
+    return (
+        replied is not None
+        and commands is not None
+        and {"imported", "ready", "first_update"} <= set(stages)
+        and process.returncode == 0
+    )
+
+def synthetic_png(width: int, height: int) -> bytes:
+    """Build a detailed PNG similar in weight to what Pollinations returns."""
+    from io import BytesIO
+    from PIL import Image
+
+    detail = Image.effect_mandelbrot((width, height), (-2.0, -1.25, 0.75, 1.25), 256)
+    noise = Image.effect_noise((width, height), 32)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (detail, Image.blend(detail, noise, 0.5), gradient))
+    output = BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+async def bench_postprocess(args) -> bool:
+    """Measure re-encoding cost and the upload time it saves per size preset."""
+    config = mikasa.POSTPROCESS_CONFIG
+    uplink = args.uplink_mbps * 1_000_000 / 8
+    fits = True
+
+    print(f"budget {config['max_bytes']} bytes, quality {config['quality']}, uplink {args.uplink_mbps} Mbit/s")
+    print(f"{'size':>10} {'format':>6} {'original':>10} {'encoded':>10} {'encode':>9} {'upload saved':>13}")
+    for width, height in SIZE_PRESETS:
+        original = synthetic_png(width, height)
+        for image_format in ("jpeg", "webp"):
+            config["format"] = image_format
+            start = time.perf_counter()
+            encoded = await mikasa.postprocess_image(original)
+            encode_time = time.perf_counter() - start
+            saved = (len(original) - len(encoded)) / uplink - encode_time
+            fits = fits and len(encoded) <= config["max_bytes"]
+            size = f"{width}x{height}"
+            print(
+                f"{size:>10} {image_format:>6} {len(original):>10} {len(encoded):>10} "
+                f"{encode_time * 1000:>7.0f}ms {saved * 1000:>11.0f}ms"
+            )
+
+    mikasa.shutdown_postprocess_executor()
+    return fits
+
+BENCHMARKS = {
+    "concurrency": bench_concurrency,
+    "coalesce": bench_coalesce,
+    "webhook": bench_webhook,
+    "variants": bench_variants,
+    "priority": bench_priority,
+    "prewarm": bench_prewarm,
+    "drain": bench_drain,
+    "health": bench_health,
+    "watchdog": bench_watchdog,
+    "replay": bench_replay,
+    "progress": bench_progress,
+    "boot": bench_boot,
+    "postprocess": bench_postprocess
+}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline Mikasa benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"], nargs="?", default="concurrency")
+    parser.add_argument("-n", "--requests", type=int, default=20, help="concurrent requests")
+    parser.add_argument("--latency", type=float, default=1.0, help="stub upstream latency in seconds")
+    parser.add_argument("--uplink-mbps", type=float, default=20.0, help="assumed upload bandwidth to Telegram")
+    parser.add_argument("--jitter", type=float, default=0.0, help="log-normal spread of stub upstream latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub upstream responses that fail")
+    parser.add_argument("--rate", type=float, default=20.0, help="replay arrival rate in events per second")
+    parser.add_argument("--mix", default=TRAFFIC_MIX, help="replay traffic weights, e.g. private=5,group=3")
+    parser.add_argument("--seed", type=int, default=0, help="seed for replay traffic and stub behaviour")
+    parser.add_argument("--max-p95", type=float, default=0.0, help="fail replay when end-to-end p95 exceeds this")
+    args = parser.parse_args()
+
+    if args.benchmark == "all":
+        # Each benchmark tunes module state, so every one gets a fresh process
+        failed = [
+            name for name in sorted(BENCHMARKS)
+            if subprocess.run([sys.executable, __file__, name]).returncode != 0
+        ]
+        print(f"FAIL: {', '.join(failed)}" if failed else "PASS")
+        sys.exit(1 if failed else 0)
+
+    passed = asyncio.run(BENCHMARKS[args.benchmark](args))
+    print("PASS" if passed else "FAIL")
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
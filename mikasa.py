@@ -1,29 +1,44 @@
 # Ok
+from __future__ import annotations
+
+import time
+
+# Boot clock fallback where /proc is not available
+BOOT_STARTED = time.monotonic()
+
 import os
+import sys
 import logging
 import asyncio
 import random
+import hmac
+import signal
+import hashlib
+import sqlite3
+import functools
+import traceback
 from io import BytesIO
-from typing import Optional
-import requests
-from PIL import Image
-import base64
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from contextlib import asynccontextmanager, contextmanager
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import quote
+import httpx
 import json
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
-from telegram.ext import (
-    Application, 
-    CommandHandler, 
-    MessageHandler, 
-    CallbackQueryHandler,
-    ContextTypes,
-    filters
-)
+
+from telegram import Bot, Update, Message, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter
 import html
 
+# telegram.ext is only needed to build the Application, workers never load it;
+# Pillow is imported by the first re-encode
+if TYPE_CHECKING:
+    from telegram.ext import Application, ContextTypes
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -34,6 +49,13 @@ logger = logging.getLogger(__name__)
 # Bot configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "YOUR_TELEGRAM_BOT_TOKEN_HERE"
 
+# Optional self-hosted (or local test) Bot API server, e.g. http://localhost:8081
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+# Process role: "all" handles everything in one process, "ingress" receives
+# updates and queues generation jobs, "worker" runs queued generations
+PROCESS_ROLE = os.getenv("MIKASA_ROLE", "all")
+
 # Bot configuration links
 BOT_LINKS = {
     "updates_channel": "https://t.me/WorkGlows",
@@ -193,6 +215,7 @@ HELP_MESSAGES = {
 <b>🥀 Available Commands:</b>
 • <code>/start</code> - Main menu and bot info
 • <code>/generate</code> - Full generation interface
+• <code>/generate x4 [prompt]</code> - Up to 4 variants in one album
 • <code>/help</code> - This help guide
 
 <b>💐️ Features:</b>
@@ -218,7 +241,10 @@ STATUS_MESSAGES = {
         "🎭 Bringing art to life...",
         "💫 Weaving pixels...",
         "🌺 Blooming creation..."
-    ]
+    ],
+    # Progress edits of the status message while a generation runs or waits
+    "progress_running": "{status}\n\n⏳ {elapsed}s",
+    "progress_queued": "{status}\n\n⏳ {elapsed}s · #{position} in line"
 }
 
 # Error messages with user mention placeholders
@@ -249,7 +275,19 @@ ERROR_MESSAGES = {
 
 <blockquote>Sometimes dreams take time to bloom, but this one wandered off 🥀.</blockquote>
 
-💘 Maybe try a simpler idea!"""
+💘 Maybe try a simpler idea!""",
+
+    "busy": """🌺 <b>So many dreams at once {user_name}!</b>
+
+<blockquote>My easel is full right now and there's a long line waiting. 🎨</blockquote>
+
+💘 Please try again in a little while!""",
+
+    "rate_limited": """🌺 <b>Slow down a little {user_name}!</b>
+
+<blockquote>You're sending prompts faster than I can paint them. 🎨</blockquote>
+
+💘 Give me a moment and try again!"""
 }
 
 # Success messages
@@ -260,6 +298,10 @@ SUCCESS_MESSAGES = {
 
     "image_for_user": """🌺 <b>Generated for {user_name}</b>
 
+<blockquote>{prompt}</blockquote>""",
+
+    "image_variant": """🌺 <b>Variant {index} for {user_name}</b>
+
 <blockquote>{prompt}</blockquote>""",
 
     "model_selected": """✅ <b>Model Selected for {user_name}</b>
@@ -390,53 +432,718 @@ STYLE_PRESETS = {
     "minimalist": "minimalist style, clean, simple, modern"
 }
 
-# HTTP Server for uptime monitoring
-class DummyHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Sakura bot is alive!")
+# Inline keyboards without per-user state, built once and shared by every chat
+BACK_TO_GENERATE_ROW = [InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")]
+
+KEYBOARDS = {
+    "generate_menu": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🤖 Select Model", callback_data="select_model"),
+            InlineKeyboardButton("🎨 Generate Sample", callback_data="sample")
+        ],
+        [
+            InlineKeyboardButton("⚙️ Settings", callback_data="settings_menu"),
+            InlineKeyboardButton("❓ Help", callback_data="help_menu")
+        ],
+        [
+            InlineKeyboardButton("🌟 Style Presets", callback_data="style_presets"),
+            InlineKeyboardButton("🎲 Random Prompt", callback_data="random_prompt")
+        ],
+        [
+            InlineKeyboardButton("📊 Image Sizes", callback_data="size_options"),
+            InlineKeyboardButton("🔄 Reset Settings", callback_data="reset_settings")
+        ],
+        [
+            InlineKeyboardButton("🎞️ Sample Album", callback_data="sample_album")
+        ]
+    ]),
+    "expand_guide": InlineKeyboardMarkup([
+        [InlineKeyboardButton("📖 Expand Guide", callback_data="expand_guide")]
+    ]),
+    "minimize_guide": InlineKeyboardMarkup([
+        [InlineKeyboardButton("📚 Minimize Guide", callback_data="minimize_guide")]
+    ]),
+    "delete": InlineKeyboardMarkup([
+        [InlineKeyboardButton("🗑️ Delete", callback_data="delete_message")]
+    ]),
+    "model_selected": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
+            InlineKeyboardButton("🤖 Change Model", callback_data="select_model")
+        ],
+        BACK_TO_GENERATE_ROW
+    ]),
+    "size_updated": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
+            InlineKeyboardButton("📊 More Sizes", callback_data="size_options")
+        ],
+        BACK_TO_GENERATE_ROW
+    ]),
+    "style_applied": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
+            InlineKeyboardButton("🌟 Change Style", callback_data="style_presets")
+        ],
+        BACK_TO_GENERATE_ROW
+    ]),
+    "settings_reset": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
+            InlineKeyboardButton("⚙️ Settings", callback_data="settings_menu")
+        ],
+        BACK_TO_GENERATE_ROW
+    ]),
+    "settings_menu": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("512x512", callback_data="size_512"),
+            InlineKeyboardButton("768x768", callback_data="size_768"),
+            InlineKeyboardButton("1024x1024", callback_data="size_1024")
+        ],
+        [
+            InlineKeyboardButton("Portrait 512x768", callback_data="size_512_768"),
+            InlineKeyboardButton("Landscape 768x512", callback_data="size_768_512")
+        ],
+        [
+            InlineKeyboardButton("🔄 Reset", callback_data="reset_settings"),
+            InlineKeyboardButton("⬅️ Back", callback_data="back_to_generate")
+        ]
+    ]),
+    "help_menu": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎨 Try Sample", callback_data="sample"),
+            InlineKeyboardButton("🤖 Select Model", callback_data="select_model")
+        ],
+        BACK_TO_GENERATE_ROW
+    ]),
+    "style_presets": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("🎌 Anime", callback_data="style_anime"),
+            InlineKeyboardButton("📸 Realistic", callback_data="style_realistic")
+        ],
+        [
+            InlineKeyboardButton("🧙 Fantasy", callback_data="style_fantasy"),
+            InlineKeyboardButton("🌆 Cyberpunk", callback_data="style_cyberpunk")
+        ],
+        [
+            InlineKeyboardButton("🎨 Cartoon", callback_data="style_cartoon"),
+            InlineKeyboardButton("🖼️ Oil Painting", callback_data="style_oil_painting")
+        ],
+        [
+            InlineKeyboardButton("🌊 Watercolor", callback_data="style_watercolor"),
+            InlineKeyboardButton("💻 Digital Art", callback_data="style_digital_art")
+        ],
+        [
+            InlineKeyboardButton("📼 Vintage", callback_data="style_vintage"),
+            InlineKeyboardButton("🔵 Minimalist", callback_data="style_minimalist")
+        ],
+        [
+            InlineKeyboardButton("🔄 Clear Style", callback_data="reset_settings"),
+            InlineKeyboardButton("⬅️ Back", callback_data="back_to_generate")
+        ]
+    ]),
+    "size_options": InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("512x512 (Square)", callback_data="size_512"),
+            InlineKeyboardButton("768x768 (Square)", callback_data="size_768")
+        ],
+        [
+            InlineKeyboardButton("1024x1024 (Square)", callback_data="size_1024"),
+            InlineKeyboardButton("1024x768 (Wide)", callback_data="size_1024_768")
+        ],
+        [
+            InlineKeyboardButton("512x768 (Portrait)", callback_data="size_512_768"),
+            InlineKeyboardButton("768x512 (Landscape)", callback_data="size_768_512")
+        ],
+        BACK_TO_GENERATE_ROW
+    ])
+}
+
+@functools.lru_cache(maxsize=None)
+def model_selection_keyboard(current_model: str) -> InlineKeyboardMarkup:
+    """Model list with the current model ticked, one shared markup per model."""
+    keyboard = []
+    for model_key, model_info in API_SERVICE["models"].items():
+        status = "✅" if current_model == model_key else ""
+        keyboard.append([InlineKeyboardButton(
+            f"{status} {model_info['name']}", 
+            callback_data=f"model_{model_key}"
+        )])
+    keyboard.append(BACK_TO_GENERATE_ROW)
+    return InlineKeyboardMarkup(keyboard)
+
+@functools.lru_cache(maxsize=64)
+def start_keyboard(bot_username: str) -> InlineKeyboardMarkup:
+    """Links shown under the /start photo."""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Updates", url=BOT_LINKS["updates_channel"]),
+            InlineKeyboardButton("Support", url=BOT_LINKS["support_group"])
+        ],
+        [
+            InlineKeyboardButton("Add Me To Your Group", url=f"https://t.me/{bot_username}?startgroup=true")
+        ]
+    ])
 
-    def do_HEAD(self):
-        self.send_response(200)
-        self.end_headers()
+# Prometheus-style metrics registry
+METRICS_REGISTRY = []
 
-    def log_message(self, format, *args):
-        pass
+class Metric:
+    """Base class for labelled metrics rendered in the Prometheus text format."""
+    
+    kind = "untyped"
+    
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        # label values tuple -> value (or histogram state)
+        self._values = {}
+        METRICS_REGISTRY.append(self)
+    
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+    
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [
+            '%s="%s"' % (label, value.replace("\\", "\\\\").replace('"', '\\"'))
+            for label, value in zip(self.labels, key)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in list(self._values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
 
-def start_dummy_server():
-    logger.info("🌐 Starting HTTP health check server")
-    port = int(os.environ.get("PORT", 5000))
-    try:
-        server = HTTPServer(("0.0.0.0", port), DummyHandler)
-        logger.info(f"✅ HTTP server listening on 0.0.0.0:{port}")
-        server.serve_forever()
-    except Exception as e:
-        logger.error(f"❌ Failed to start HTTP server: {e}")
-        raise
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+    
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name: str, help_text: str, buckets: tuple, labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+    
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket counts followed by sum and count
+            state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+    
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in list(self._values.items()):
+            state = list(state)
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = self._format_labels(key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = self._format_labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {state[-1]}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {state[-2]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {state[-1]}")
+        return lines
+
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120)
+FAST_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+UPSTREAM_LATENCY = Histogram(
+    "mikasa_upstream_latency_seconds", "Pollinations request latency",
+    LATENCY_BUCKETS, ("model", "size")
+)
+UPLOAD_SECONDS = Histogram(
+    "mikasa_upload_seconds", "Telegram photo and album upload call time", FAST_BUCKETS
+)
+GENERATION_SECONDS = Histogram(
+    "mikasa_generation_seconds", "End-to-end prompt to photo latency", LATENCY_BUCKETS, ("priority",)
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "mikasa_queue_wait_seconds", "Time spent waiting for a generation slot", FAST_BUCKETS, ("priority",)
+)
+GENERATIONS_TOTAL = Counter(
+    "mikasa_generations_total", "Upstream generations by result", ("result",)
+)
+CALLBACK_QUERIES_TOTAL = Counter(
+    "mikasa_callback_queries_total", "Callback queries by route", ("route",)
+)
+RATE_LIMITED_TOTAL = Counter(
+    "mikasa_rate_limited_total", "Generation requests refused by the rate limiter", ("kind",)
+)
+OUTBOUND_REQUESTS_TOTAL = Counter(
+    "mikasa_outbound_requests_total", "Paced Bot API calls by outcome", ("result",)
+)
+OUTBOUND_WAIT_SECONDS = Histogram(
+    "mikasa_outbound_wait_seconds", "Time Bot API calls waited for flood-limit budget", FAST_BUCKETS
+)
+GENERATIONS_IN_FLIGHT = Gauge(
+    "mikasa_generations_in_flight", "Upstream generations currently running"
+)
+UPSTREAM_RETRIES_TOTAL = Counter(
+    "mikasa_upstream_retries_total", "Pollinations requests retried after a failure"
+)
+UPSTREAM_HEDGES_TOTAL = Counter(
+    "mikasa_upstream_hedges_total", "Hedged Pollinations requests sent"
+)
+POSTPROCESS_SECONDS = Histogram(
+    "mikasa_postprocess_seconds", "Image re-encoding time", FAST_BUCKETS
+)
+POSTPROCESS_BYTES_TOTAL = Counter(
+    "mikasa_postprocess_bytes_total", "Image bytes before and after re-encoding", ("stage",)
+)
+BOOT_SECONDS = Gauge(
+    "mikasa_boot_seconds", "Seconds from process start to each boot stage", ("stage",)
+)
+PROGRESS_EDITS_TOTAL = Counter(
+    "mikasa_progress_edits_total", "Status progress edits by outcome", ("result",)
+)
+UPSTREAM_CIRCUIT_STATE = Gauge(
+    "mikasa_upstream_circuit_state", "Pollinations circuit state (0 closed, 1 half-open, 2 open)"
+)
+
+LOOP_LAG_SECONDS = Gauge(
+    "mikasa_loop_lag_seconds", "How late the event loop woke the last lag probe"
+)
+LOOP_STALL_SECONDS = Histogram(
+    "mikasa_loop_stall_seconds", "Event loop stalls past the watchdog threshold", FAST_BUCKETS
+)
+LOOP_STALLS_TOTAL = Counter(
+    "mikasa_loop_stalls_total", "Event loop stalls caught by the watchdog, by running handler", ("handler",)
+)
+HANDLER_SECONDS = Histogram(
+    "mikasa_handler_seconds", "Update handler wall time", FAST_BUCKETS, ("handler",)
+)
+
+# Readiness thresholds, a replica past any of them asks to be taken out of rotation
+HEALTH_CONFIG = {
+    "lag_interval": float(os.getenv("HEALTH_LAG_INTERVAL", "0.5")),
+    "max_loop_lag": float(os.getenv("HEALTH_MAX_LOOP_LAG", "1.0")),
+    # Readiness judges the worst lag over this many seconds, not one probe
+    "lag_window": float(os.getenv("HEALTH_LAG_WINDOW", "10")),
+    # Fraction of the scheduler queue that counts as saturated
+    "max_queue_fill": float(os.getenv("HEALTH_MAX_QUEUE_FILL", "0.8")),
+    # Consecutive Bot API network failures before Telegram counts as unreachable
+    "max_telegram_failures": int(os.getenv("HEALTH_MAX_TELEGRAM_FAILURES", "3"))
+}
+
+# Loop watchdog, a thread that catches the loop thread while something blocks it
+WATCHDOG_CONFIG = {
+    # Lag past the expected wakeup that counts as a stall worth a stack trace
+    "stall_threshold": float(os.getenv("LOOP_STALL_THRESHOLD", "0.25")),
+    "check_interval": float(os.getenv("LOOP_WATCHDOG_INTERVAL", "0.1")),
+    # Sampling profiler, enabled by a dump path; folded stacks for flame graphs
+    "profile_path": os.getenv("PROFILE_DUMP_PATH", ""),
+    "profile_interval": float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005")),
+    "profile_flush": float(os.getenv("PROFILE_FLUSH_INTERVAL", "60"))
+}
+
+class LoopLagMonitor:
+    """Measure how late the event loop wakes a periodic sleep.
+    
+    A probe task on the loop beats a heartbeat. A watchdog thread notices
+    when the beat goes stale, logs the loop thread's stack and blames the
+    handler whose task is running; with a profile path it also samples
+    that stack continuously and dumps the folded counts.
+    """
+    
+    def __init__(self, interval: float, window: float, stall_threshold: float, check_interval: float,
+                 profile_path: str, profile_interval: float, profile_flush: float):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.check_interval = check_interval
+        self.profile_path = profile_path
+        self.profile_interval = profile_interval
+        self.profile_flush = profile_flush
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        # (handler, formatted stack) of the last stall caught
+        self.last_stall = None
+        self._recent = deque(maxlen=max(1, int(window / interval)))
+        # task -> name of the handler it is running
+        self._handlers = {}
+        # folded stack -> samples
+        self._profile = {}
+        self._task = None
+        self._loop = None
+        self._loop_thread = None
+        self._beat = 0.0
+        self._thread = None
+        self._stopping = threading.Event()
+    
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = self._loop.create_task(self._run())
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+    
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            self._stopping.set()
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+    
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            self._recent.append(self.lag)
+            LOOP_LAG_SECONDS.set(self.lag)
+            if self.lag > self.stall_threshold:
+                LOOP_STALL_SECONDS.observe(self.lag)
+    
+    def _watch(self) -> None:
+        """Watchdog thread: catch stalls in the act and sample the loop thread's stack."""
+        tick = self.profile_interval if self.profile_path else self.check_interval
+        reported_beat = None
+        next_flush = time.monotonic() + self.profile_flush
+        while not self._stopping.wait(tick):
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            now = time.monotonic()
+            beat = self._beat
+            if now - beat > self.interval + self.stall_threshold and beat != reported_beat:
+                # Report each stall once, while the culprit is still on the stack
+                reported_beat = beat
+                self._report_stall(frame, now - beat - self.interval)
+            if self.profile_path:
+                self._sample(frame)
+                if now >= next_flush:
+                    next_flush = now + self.profile_flush
+                    self._dump_profile()
+        if self.profile_path:
+            self._dump_profile()
+    
+    def _report_stall(self, frame, stalled: float) -> None:
+        task = asyncio.current_task(self._loop)
+        handler = self._handlers.get(task, "loop")
+        stack = "".join(traceback.format_stack(frame))
+        self.stalls += 1
+        self.last_stall = (handler, stack)
+        LOOP_STALLS_TOTAL.inc(handler=handler)
+        logger.warning(f"Event loop blocked for {stalled:.2f}s+ in {handler}:\n{stack}")
+    
+    def _sample(self, frame) -> None:
+        # An idle loop sits in the selector, only count samples doing work
+        if frame.f_code.co_filename.endswith("selectors.py"):
+            return
+        names = []
+        while frame is not None:
+            names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        folded = ";".join(reversed(names))
+        self._profile[folded] = self._profile.get(folded, 0) + 1
+    
+    def _dump_profile(self) -> None:
+        lines = [f"{stack} {count}\n" for stack, count in sorted(self._profile.items(), key=lambda item: -item[1])]
+        temp_path = self.profile_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                f.writelines(lines)
+            os.replace(temp_path, self.profile_path)
+        except OSError as e:
+            logger.warning(f"Failed to write profile to {self.profile_path}: {e}")
+    
+    @contextmanager
+    def handler(self, name: str):
+        """Time a handler into HANDLER_SECONDS and blame it for stalls while it runs."""
+        task = asyncio.current_task()
+        previous = self._handlers.get(task)
+        self._handlers[task] = name
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+            if previous is None:
+                self._handlers.pop(task, None)
+            else:
+                self._handlers[task] = previous
+    
+    def recent_lag(self) -> float:
+        """Return the worst lag within the window."""
+        return max(self._recent, default=0.0)
+    
+    def stats(self) -> dict:
+        """Return the last, recent worst and all-time worst lag, and stalls caught."""
+        return {
+            "lag": round(self.lag, 4),
+            "recent_lag": round(self.recent_lag(), 4),
+            "max_lag": round(self.max_lag, 4),
+            "stalls": self.stalls
+        }
+
+loop_monitor = LoopLagMonitor(
+    HEALTH_CONFIG["lag_interval"],
+    HEALTH_CONFIG["lag_window"],
+    WATCHDOG_CONFIG["stall_threshold"],
+    WATCHDOG_CONFIG["check_interval"],
+    WATCHDOG_CONFIG["profile_path"],
+    WATCHDOG_CONFIG["profile_interval"],
+    WATCHDOG_CONFIG["profile_flush"]
+)
 
-def start_uptime_server():
-    """Start HTTP server for uptime monitoring"""
-    port = int(os.environ.get('PORT', 8080))
+# Boot stage -> seconds after process start
+BOOT_STAGES = {}
+
+def process_uptime() -> float:
+    """Return seconds since the process started, interpreter startup included where /proc allows."""
     try:
-        server = HTTPServer(('0.0.0.0', port), UptimeHandler)
-        logger.info(f"Starting uptime server on port {port}")
-        server.serve_forever()
-    except Exception as e:
-        logger.error(f"Failed to start uptime server: {e}")
-        # Try alternative port
+        with open("/proc/self/stat") as f:
+            # starttime is the 22nd field, counted after the parenthesised command name
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - BOOT_STARTED
+
+def mark_boot(stage: str) -> None:
+    """Record and log the first time a boot stage is reached."""
+    if stage in BOOT_STAGES:
+        return
+    seconds = BOOT_STAGES[stage] = process_uptime()
+    BOOT_SECONDS.set(seconds, stage=stage)
+    logger.info(f"⏱️ Boot stage {stage} reached {seconds:.2f}s after process start")
+
+def timed_handler(func):
+    """Wrap an update handler so the loop monitor times it and can name it in stalls."""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        with loop_monitor.handler(func.__name__):
+            result = await func(update, context)
+        if "first_update" not in BOOT_STAGES:
+            mark_boot("first_update")
+        return result
+    return wrapper
+
+# Webhook ingestion configuration, webhook mode is enabled by WEBHOOK_URL
+WEBHOOK_CONFIG = {
+    "url": os.getenv("WEBHOOK_URL", ""),
+    "path": os.getenv("WEBHOOK_PATH", "/telegram"),
+    # Telegram echoes this back in X-Telegram-Bot-Api-Secret-Token, replicas share it
+    "secret": os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32],
+    "max_body": int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+}
+
+class AsyncHTTPServer:
+    """Small asyncio HTTP/1.1 server for webhook updates, health checks and metrics."""
+    
+    REASONS = {
+        200: "OK",
+        400: "Bad Request",
+        403: "Forbidden",
+        404: "Not Found",
+        408: "Request Timeout",
+        413: "Payload Too Large",
+        503: "Service Unavailable"
+    }
+    
+    def __init__(self, host: str, port: int, max_body: int = 1024 * 1024, idle_timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout
+        # (method, path) -> async handler(headers, body) -> (status, content_type, payload)
+        self.routes = {}
+        self._server = None
+    
+    def route(self, method: str, path: str, handler) -> None:
+        """Register an async handler for a method and path."""
+        self.routes[(method, path)] = handler
+    
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"✅ HTTP server listening on {self.host}:{self.port}")
+    
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
         try:
-            port = 3000
-            server = HTTPServer(('0.0.0.0', port), UptimeHandler)
-            logger.info(f"Starting uptime server on alternative port {port}")
-            server.serve_forever()
-        except Exception as e2:
-            logger.error(f"Failed to start uptime server on alternative port: {e2}")
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, _ = request_line.split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, "text/plain", b"Bad Request", False)
+                    break
+                
+                headers = {}
+                for line in header_lines:
+                    name, sep, value = line.partition(":")
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                
+                declared = headers.get("content-length") or "0"
+                if not (declared.isascii() and declared.isdigit()):
+                    await self._respond(writer, 400, "text/plain", b"Bad Request", False)
+                    break
+                length = int(declared)
+                if length > self.max_body:
+                    await self._respond(writer, 413, "text/plain", b"Payload Too Large", False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                
+                path = target.split("?", 1)[0]
+                handler = self.routes.get(("GET" if method == "HEAD" else method, path))
+                if handler is None:
+                    status, content_type, payload = 404, "text/plain", b"Not Found"
+                else:
+                    try:
+                        status, content_type, payload = await handler(headers, body)
+                    except Exception as e:
+                        logger.error(f"HTTP handler for {path} failed: {e}")
+                        status, content_type, payload = 400, "text/plain", b"Bad Request"
+                
+                await self._respond(writer, status, content_type, b"" if method == "HEAD" else payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, content_type: str,
+                       payload: bytes, keep_alive: bool) -> None:
+        writer.write(
+            f"HTTP/1.1 {status} {self.REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+            + payload
+        )
+        await writer.drain()
+
+def render_metrics() -> str:
+    """Render registered metrics and component stats in the Prometheus text format."""
+    lines = []
+    for metric in METRICS_REGISTRY:
+        lines.extend(metric.render())
+    
+    sections = {
+        "scheduler": generation_scheduler.stats(),
+        "image_cache": image_cache.stats(),
+        "flights": image_flights.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "prewarm": prewarm_pool.stats(),
+        "inflight": inflight_jobs.stats(),
+        "outbound": outbound.stats(),
+        "loop": loop_monitor.stats()
+    }
+    for section, stats in sections.items():
+        for name, value in stats.items():
+            lines.append(f"# TYPE mikasa_{section}_{name} gauge")
+            lines.append(f"mikasa_{section}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+async def health_route(headers: dict, body: bytes) -> tuple:
+    """Liveness: the event loop is answering, nothing else is checked."""
+    return 200, "text/plain", b"Sakura bot is alive!"
+
+async def readiness_checks() -> dict:
+    """Return each readiness condition and whether it currently holds."""
+    # Ingress hands generations to the shared queue, its own scheduler stays empty
+    if PROCESS_ROLE == "ingress":
+        queue_fill = await generation_queue.queue_fill()
+    else:
+        queue_fill = generation_scheduler.queue_fill()
+    return {
+        "loop_lag": loop_monitor.recent_lag() <= HEALTH_CONFIG["max_loop_lag"],
+        "upstream_circuit": upstream_breaker.state != CircuitBreaker.OPEN,
+        "queue": queue_fill < HEALTH_CONFIG["max_queue_fill"],
+        "telegram": outbound.network_failures < HEALTH_CONFIG["max_telegram_failures"],
+        "accepting": not inflight_jobs.draining
+    }
+
+async def readiness_route(headers: dict, body: bytes) -> tuple:
+    """Readiness: 503 with the failing checks while this replica should get no new traffic."""
+    checks = await readiness_checks()
+    ready = all(checks.values())
+    payload = json.dumps({"ready": ready, "checks": checks, **loop_monitor.stats()})
+    return (200 if ready else 503), "application/json", payload.encode()
+
+async def metrics_route(headers: dict, body: bytes) -> tuple:
+    return 200, "text/plain; version=0.0.4", render_metrics().encode()
+
+def make_webhook_route(application: Application, secret: str):
+    """Build the route that validates and enqueues Telegram webhook updates."""
+    async def webhook_route(headers: dict, body: bytes) -> tuple:
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, secret):
+            logger.warning("Rejected webhook request with invalid secret token")
+            return 403, "text/plain", b"Forbidden"
+        if inflight_jobs.draining:
+            # Telegram redelivers refused updates, by then to a replica that is not stopping
+            return 503, "text/plain", b"Draining"
+        
+        update = Update.de_json(json.loads(body), application.bot)
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"OK"
+    
+    return webhook_route
 
 # Pollinations AI configuration
 API_SERVICE = {
     "name": "🌸 Pollinations AI",
-    "url": "https://image.pollinations.ai/prompt/{prompt}?width={width}&height={height}&seed={seed}&model={model}",
+    "url": os.getenv(
+        "POLLINATIONS_URL",
+        "https://image.pollinations.ai/prompt/{prompt}?width={width}&height={height}&seed={seed}&model={model}"
+    ),
     "models": {
         "flux": {
             "name": "FLUX (Recommended)",
@@ -461,102 +1168,2024 @@ API_SERVICE = {
     }
 }
 
-# Default generation parameters
-DEFAULT_PARAMS = {
-    "width": 1024,
-    "height": 1024,
-    "seed": None,
-    "model": "flux"
+# Upstream HTTP client configuration
+HTTP_CONFIG = {
+    "connect_timeout": float(os.getenv("POLLINATIONS_CONNECT_TIMEOUT", "10")),
+    "read_timeout": float(os.getenv("POLLINATIONS_READ_TIMEOUT", "60")),
+    "max_connections": int(os.getenv("POLLINATIONS_MAX_CONNECTIONS", "100")),
+    "max_keepalive": int(os.getenv("POLLINATIONS_MAX_KEEPALIVE", "20")),
+    "keepalive_expiry": float(os.getenv("POLLINATIONS_KEEPALIVE_EXPIRY", "30")),
+    "max_image_bytes": int(os.getenv("POLLINATIONS_MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
 }
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /start command with random photo."""
-    # Get user's clickable mention
-    user_mention = get_clickable_user_mention(update.effective_user)
+# Shared pooled client, created lazily on the running event loop
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared upstream client, creating it on first use."""
+    global _http_client
     
-    # Select random photo
-    random_photo = random.choice(RANDOM_PHOTOS)
+    if _http_client is None or _http_client.is_closed:
+        # HTTP/2 needs the optional h2 package, fall back to HTTP/1.1 keep-alive
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        
+        _http_client = httpx.AsyncClient(
+            http2=http2,
+            follow_redirects=True,
+            timeout=httpx.Timeout(
+                HTTP_CONFIG["read_timeout"],
+                connect=HTTP_CONFIG["connect_timeout"]
+            ),
+            limits=httpx.Limits(
+                max_connections=HTTP_CONFIG["max_connections"],
+                max_keepalive_connections=HTTP_CONFIG["max_keepalive"],
+                keepalive_expiry=HTTP_CONFIG["keepalive_expiry"]
+            )
+        )
+        logger.info(f"Created upstream HTTP client (http2={http2})")
     
-    # Determine message based on chat type
-    if update.effective_chat.type == 'private':
-        welcome_message = WELCOME_MESSAGES["private"].format(user_name=user_mention)
-    else:
-        welcome_message = WELCOME_MESSAGES["group"].format(user_name=user_mention)
+    return _http_client
+
+async def close_http_client() -> None:
+    """Close the shared upstream client."""
+    global _http_client
     
-    # Keyboard with dynamic links
-    keyboard = [
-        [
-            InlineKeyboardButton("Updates", url=BOT_LINKS["updates_channel"]),
-            InlineKeyboardButton("Support", url=BOT_LINKS["support_group"])
-        ],
-        [
-            InlineKeyboardButton("Add Me To Your Group", url=f"https://t.me/{context.bot.username}?startgroup=true")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# Upstream resilience configuration
+RESILIENCE_CONFIG = {
+    "max_attempts": int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3")),
+    "backoff_base": float(os.getenv("UPSTREAM_BACKOFF_BASE", "1")),
+    "backoff_max": float(os.getenv("UPSTREAM_BACKOFF_MAX", "20")),
+    # Hedging sends a second request with another seed when the first is slow
+    "hedge": os.getenv("UPSTREAM_HEDGE", "0") == "1",
+    # Fixed hedge delay in seconds, 0 uses the observed p95 upstream latency
+    "hedge_delay": float(os.getenv("UPSTREAM_HEDGE_DELAY", "0")),
+    "hedge_min_delay": float(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "5")),
+    "breaker_threshold": int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5")),
+    "breaker_reset": float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+}
+
+class UpstreamError(Exception):
+    """A Pollinations request failed."""
     
-    # Send the photo
-    await update.message.reply_photo(
-        photo=random_photo,
-        caption=welcome_message,
-        parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
-    )
+    # Whether another attempt may succeed, and whether it suggests the upstream is down
+    retryable = True
+    counts_as_failure = True
+    retry_after = None
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /help command."""
-    # Get user's clickable mention
-    user_mention = get_clickable_user_mention(update.effective_user)
+class UpstreamTimeout(UpstreamError):
+    """Pollinations did not answer in time."""
+
+class UpstreamStatusError(UpstreamError):
+    """Pollinations answered with a non-200 status."""
     
-    keyboard = [
-        [
-            InlineKeyboardButton("📖 Expand Guide", callback_data="expand_guide")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"Pollinations API error: {status}")
+        self.status = status
+        self.retry_after = retry_after
+        self.retryable = status == 429 or status >= 500
+        self.counts_as_failure = status >= 500
+
+class UpstreamInvalidImage(UpstreamError):
+    """Pollinations returned something that is not a complete image."""
+
+class CircuitOpenError(UpstreamError):
+    """Pollinations is considered down, requests fail fast."""
     
-    await update.message.reply_text(
-        HELP_MESSAGES["basic"].format(user_name=user_mention), 
-        parse_mode=ParseMode.HTML, 
-        reply_markup=reply_markup
-    )
+    retryable = False
+    counts_as_failure = False
 
-async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /generate command with all functionality."""
-    # Get user's clickable mention
-    user_mention = get_clickable_user_mention(update.effective_user)
+class CircuitBreaker:
+    """Open after consecutive upstream failures, then let one probe through per reset period."""
+    
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0
+    
+    def allow(self) -> bool:
+        """Return whether a request may be sent now."""
+        now = time.monotonic()
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and now - self._opened_at < self.reset_timeout:
+            return False
+        # Half-open: a single probe at a time, replaced if it never reported back
+        if self.state == self.HALF_OPEN and now - self._probe_at < self.reset_timeout:
+            return False
+        self._set_state(self.HALF_OPEN)
+        self._probe_at = now
+        return True
+    
+    def record_success(self) -> None:
+        self._failures = 0
+        if self.state != self.CLOSED:
+            logger.info("Pollinations circuit closed")
+            self._set_state(self.CLOSED)
+    
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Pollinations circuit opened after {self._failures} failures")
+            self._set_state(self.OPEN)
+            self._opened_at = time.monotonic()
+    
+    def _set_state(self, state: int) -> None:
+        self.state = state
+        UPSTREAM_CIRCUIT_STATE.set(state)
+
+upstream_breaker = CircuitBreaker(RESILIENCE_CONFIG["breaker_threshold"], RESILIENCE_CONFIG["breaker_reset"])
+
+# Recent successful upstream latencies, used to pick the hedge delay
+recent_upstream_latencies = deque(maxlen=200)
+
+# Image post-processing configuration, disabled unless a format is chosen
+POSTPROCESS_CONFIG = {
+    # "jpeg" (progressive) or "webp", empty uploads Pollinations output as is
+    "format": os.getenv("POSTPROCESS_FORMAT", "").lower(),
+    "quality": int(os.getenv("POSTPROCESS_QUALITY", "85")),
+    "min_quality": int(os.getenv("POSTPROCESS_MIN_QUALITY", "50")),
+    "max_bytes": int(os.getenv("POSTPROCESS_MAX_BYTES", str(1024 * 1024))),
+    # "thread" or "process" pool for encoding work
+    "executor": os.getenv("POSTPROCESS_EXECUTOR", "thread"),
+    "workers": int(os.getenv("POSTPROCESS_WORKERS", "2"))
+}
+
+_postprocess_executor = None
+
+def encode_image(image, image_format: str, quality: int) -> bytes:
+    """Encode a Pillow image without any metadata."""
+    output = BytesIO()
+    if image_format == "webp":
+        image.save(output, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+def postprocess_image_sync(data: bytes, image_format: str, quality: int, min_quality: int, max_bytes: int) -> bytes:
+    """Re-encode image bytes, searching quality and then size to fit the byte budget."""
+    from PIL import Image
+    
+    with Image.open(BytesIO(data)) as source:
+        # Converting drops EXIF, ICC and text chunks along with any alpha channel
+        image = source.convert("RGB")
+    
+    for _ in range(4):
+        encoded = encode_image(image, image_format, quality)
+        if len(encoded) <= max_bytes:
+            return encoded
+        
+        # Binary search for the highest quality that fits
+        best = None
+        low, high = min_quality, quality - 1
+        while low <= high:
+            middle = (low + high) // 2
+            candidate = encode_image(image, image_format, middle)
+            if len(candidate) <= max_bytes:
+                best, low = candidate, middle + 1
+            else:
+                high = middle - 1
+        if best is not None:
+            return best
+        
+        # Even the lowest quality is too big, shrink the image and try again
+        scale = max(0.5, (max_bytes / len(encoded)) ** 0.5 * 0.9)
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+    
+    return encoded
+
+def get_postprocess_executor():
+    """Return the pool that runs encoding off the event loop."""
+    global _postprocess_executor
+    
+    if _postprocess_executor is None:
+        if POSTPROCESS_CONFIG["executor"] == "process":
+            _postprocess_executor = ProcessPoolExecutor(max_workers=POSTPROCESS_CONFIG["workers"])
+        else:
+            _postprocess_executor = ThreadPoolExecutor(
+                max_workers=POSTPROCESS_CONFIG["workers"],
+                thread_name_prefix="postprocess"
+            )
+    return _postprocess_executor
+
+def shutdown_postprocess_executor() -> None:
+    """Stop the encoding pool, if it was started."""
+    global _postprocess_executor
+    
+    if _postprocess_executor is not None:
+        _postprocess_executor.shutdown(wait=False)
+        _postprocess_executor = None
+
+async def postprocess_image(data: bytes) -> bytes:
+    """Re-encode and size-budget an image in the worker pool, if enabled."""
+    image_format = POSTPROCESS_CONFIG["format"]
+    if image_format not in ("jpeg", "webp"):
+        return data
+    
+    start = time.perf_counter()
+    try:
+        processed = await asyncio.get_running_loop().run_in_executor(
+            get_postprocess_executor(),
+            functools.partial(
+                postprocess_image_sync,
+                data,
+                image_format,
+                POSTPROCESS_CONFIG["quality"],
+                POSTPROCESS_CONFIG["min_quality"],
+                POSTPROCESS_CONFIG["max_bytes"]
+            )
+        )
+    except Exception as e:
+        logger.error(f"Image post-processing failed, uploading original: {e}")
+        return data
+    
+    POSTPROCESS_SECONDS.observe(time.perf_counter() - start)
+    POSTPROCESS_BYTES_TOTAL.inc(len(data), stage="in")
+    POSTPROCESS_BYTES_TOTAL.inc(len(processed), stage="out")
+    return processed
+
+# Rate limits as (burst, refill per minute), per user and per group chat
+RATE_LIMIT_CONFIG = {
+    "enabled": os.getenv("RATE_LIMIT_ENABLED", "1") != "0",
+    "budgets": {
+        "text": {"user": (3, 6), "chat": (10, 20)},
+        "generate": {"user": (4, 8), "chat": (10, 20)},
+        "callback": {"user": (4, 6), "chat": (8, 12)}
+    },
+    "idle_ttl": float(os.getenv("RATE_LIMIT_IDLE_TTL", "600")),
+    "sweep_interval": float(os.getenv("RATE_LIMIT_SWEEP_INTERVAL", "60"))
+}
+
+class RateLimiter:
+    """Token buckets per (kind, user) and (kind, chat) with idle-bucket expiry."""
+    
+    ALLOW = "allow"
+    WARN = "warn"
+    DROP = "drop"
+    
+    def __init__(self, budgets: dict, idle_ttl: float, sweep_interval: float, enabled: bool = True):
+        self.budgets = budgets
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.enabled = enabled
+        
+        # key -> [tokens, last refill, warned since last allowed request]
+        self._buckets = {}
+        self._last_sweep = time.monotonic()
+        self._allowed = 0
+        self._limited = 0
+        self._expired = 0
+    
+    def _bucket(self, key: tuple, burst: int, per_minute: float, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(burst), now, False]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * per_minute / 60)
+            bucket[1] = now
+        return bucket
+    
+    def _sweep(self, now: float) -> None:
+        # Idle buckets have refilled long ago, dropping them loses nothing
+        idle = [key for key, bucket in self._buckets.items() if now - bucket[1] > self.idle_ttl]
+        for key in idle:
+            del self._buckets[key]
+        self._expired += len(idle)
+        self._last_sweep = now
+    
+    def check(self, kind: str, user_id: int, chat_id: int, cost: int = 1) -> str:
+        """Spend cost tokens from the user and chat buckets.
+        
+        Returns ALLOW, WARN for the first refusal since the last allowed
+        request, or DROP for refusals the user has already been told about.
+        """
+        if not self.enabled:
+            return self.ALLOW
+        
+        now = time.monotonic()
+        if now - self._last_sweep > self.sweep_interval:
+            self._sweep(now)
+        
+        budget = self.budgets[kind]
+        buckets = [self._bucket((kind, "user", user_id), *budget["user"], now)]
+        if chat_id != user_id:
+            # Private chats share the user's id, only groups get a second bucket
+            buckets.append(self._bucket((kind, "chat", chat_id), *budget["chat"], now))
+        
+        if all(bucket[0] >= cost for bucket in buckets):
+            for bucket in buckets:
+                bucket[0] -= cost
+            buckets[0][2] = False
+            self._allowed += 1
+            return self.ALLOW
+        
+        self._limited += 1
+        RATE_LIMITED_TOTAL.inc(kind=kind)
+        if buckets[0][2]:
+            return self.DROP
+        buckets[0][2] = True
+        return self.WARN
+    
+    def stats(self) -> dict:
+        """Return bucket count and decision counters."""
+        return {
+            "buckets": len(self._buckets),
+            "allowed": self._allowed,
+            "limited": self._limited,
+            "expired": self._expired
+        }
+
+rate_limiter = RateLimiter(
+    RATE_LIMIT_CONFIG["budgets"],
+    RATE_LIMIT_CONFIG["idle_ttl"],
+    RATE_LIMIT_CONFIG["sweep_interval"],
+    RATE_LIMIT_CONFIG["enabled"]
+)
+
+async def allow_generation(update: Update, kind: str, cost: int = 1) -> bool:
+    """Apply the rate limit to a message-triggered generation, replying when limited."""
+    decision = rate_limiter.check(kind, update.effective_user.id, update.effective_chat.id, cost)
+    if decision == RateLimiter.ALLOW:
+        return True
+    
+    # Groups stay quiet, private chats hear about it once per burst
+    if decision == RateLimiter.WARN and update.effective_chat.type == 'private':
+        await update.message.reply_text(
+            ERROR_MESSAGES["rate_limited"].format(
+                user_name=get_clickable_user_mention(update.effective_user)
+            ),
+            parse_mode=ParseMode.HTML
+        )
+    return False
+
+# Telegram flood limits as (burst, messages per second)
+OUTBOUND_CONFIG = {
+    "global": (30, float(os.getenv("OUTBOUND_GLOBAL_PER_SECOND", "25"))),
+    "private": (3, 1.0),
+    "group": (3, float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20")) / 60),
+    "max_retries": 3,
+    "idle_ttl": 300
+}
+
+class OutboundRequest:
+    """A Bot API call waiting for flood-limit budget."""
+    
+    __slots__ = ("chat_id", "call", "priority", "key", "seq", "future", "queued_at", "attempts")
+    
+    def __init__(self, chat_id: int, call, priority: int, key: Optional[tuple], seq: int, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.key = key
+        self.seq = seq
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundSender:
+    """Pace Bot API calls under global and per-chat token buckets.
+    
+    Results go out before cosmetic status updates. A request with a key
+    supersedes status requests still waiting with the same key and never
+    overtakes one already on its way, and RetryAfter pauses the chat and
+    puts the request back in line.
+    """
+    
+    RESULT = 0
+    STATUS = 1
+    
+    def __init__(self, global_budget: tuple, private_budget: tuple, group_budget: tuple,
+                 max_retries: int, idle_ttl: float):
+        self.global_budget = global_budget
+        self.private_budget = private_budget
+        self.group_budget = group_budget
+        self.max_retries = max_retries
+        self.idle_ttl = idle_ttl
+        
+        self._pending = []
+        self._seq = 0
+        self._global = [float(global_budget[0]), time.monotonic()]
+        # chat_id -> [tokens, last refill, paused until]
+        self._chats = {}
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+        self._executing = set()
+        # Keys with a request in flight, later ones wait so edits land in order
+        self._active_keys = set()
+        
+        self._sent = 0
+        self._superseded = 0
+        self._retried = 0
+        # Consecutive calls that never reached Telegram, reset by any success
+        self.network_failures = 0
+    
+    def _chat_budget(self, chat_id: int) -> tuple:
+        return self.group_budget if chat_id < 0 else self.private_budget
+    
+    @staticmethod
+    def _refill(bucket: list, budget: tuple, now: float) -> None:
+        burst, rate = budget
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    
+    def _chat_ready_at(self, chat_id: int, now: float) -> float:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = [float(self._chat_budget(chat_id)[0]), now, 0.0]
+        budget = self._chat_budget(chat_id)
+        self._refill(bucket, budget, now)
+        ready_at = now if bucket[0] >= 1 else now + (1 - bucket[0]) / budget[1]
+        return max(ready_at, bucket[2])
+    
+    def _sweep(self, now: float) -> None:
+        busy = {request.chat_id for request in self._pending}
+        for chat_id, bucket in list(self._chats.items()):
+            if chat_id not in busy and now - bucket[1] > self.idle_ttl and bucket[2] <= now:
+                del self._chats[chat_id]
+    
+    def _ensure_running(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._dispatch())
+    
+    async def send(self, chat_id: int, call, priority: int = RESULT, key: Optional[tuple] = None):
+        """Run call() once the chat and global budgets allow, returning its result.
+        
+        Returns None without calling when a later request with the same key
+        supersedes this status request.
+        """
+        self._ensure_running()
+        
+        if key is not None:
+            for request in [r for r in self._pending if r.key == key and r.priority == self.STATUS]:
+                self._pending.remove(request)
+                self._superseded += 1
+                OUTBOUND_REQUESTS_TOTAL.inc(result="superseded")
+                if not request.future.done():
+                    request.future.set_result(None)
+        
+        self._seq += 1
+        future = self._loop.create_future()
+        self._pending.append(OutboundRequest(chat_id, call, priority, key, self._seq, future))
+        self._wakeup.set()
+        return await future
+    
+    async def _dispatch(self) -> None:
+        last_sweep = time.monotonic()
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            self._refill(self._global, self.global_budget, now)
+            if now - last_sweep > self.idle_ttl:
+                self._sweep(now)
+                last_sweep = now
+            
+            # Highest priority first, oldest first within a priority
+            chosen = None
+            delay = None
+            for request in sorted(self._pending, key=lambda r: (r.priority, r.seq)):
+                if request.future.done():
+                    self._pending.remove(request)
+                    continue
+                if request.key is not None and request.key in self._active_keys:
+                    continue
+                ready_at = self._chat_ready_at(request.chat_id, now)
+                if ready_at <= now:
+                    chosen = request
+                    break
+                delay = ready_at - now if delay is None else min(delay, ready_at - now)
+            
+            if chosen is not None:
+                if self._global[0] >= 1:
+                    self._global[0] -= 1
+                    self._chats[chosen.chat_id][0] -= 1
+                    self._pending.remove(chosen)
+                    if chosen.key is not None:
+                        self._active_keys.add(chosen.key)
+                    OUTBOUND_WAIT_SECONDS.observe(now - chosen.queued_at)
+                    task = self._loop.create_task(self._execute(chosen))
+                    self._executing.add(task)
+                    task.add_done_callback(self._executing.discard)
+                    continue
+                delay = (1 - self._global[0]) / self.global_budget[1]
+            
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _execute(self, request: OutboundRequest) -> None:
+        try:
+            await self._call(request)
+        finally:
+            if request.key is not None:
+                self._active_keys.discard(request.key)
+                self._wakeup.set()
+    
+    async def _call(self, request: OutboundRequest) -> None:
+        try:
+            result = await request.call()
+        except RetryAfter as e:
+            # Telegram told us to back off this chat, everything queued for it waits too
+            bucket = self._chats.get(request.chat_id)
+            if bucket is not None:
+                bucket[2] = max(bucket[2], time.monotonic() + float(e.retry_after))
+            if request.attempts < self.max_retries and not request.future.done():
+                logger.warning(f"Flood limit hit in chat {request.chat_id}, retrying in {e.retry_after}s")
+                request.attempts += 1
+                self._retried += 1
+                OUTBOUND_REQUESTS_TOTAL.inc(result="retried")
+                self._pending.append(request)
+                self._wakeup.set()
+                return
+            OUTBOUND_REQUESTS_TOTAL.inc(result="failed")
+            if not request.future.done():
+                request.future.set_exception(e)
+            return
+        except Exception as e:
+            OUTBOUND_REQUESTS_TOTAL.inc(result="failed")
+            # BadRequest is Telegram answering, only transport failures count against it
+            if isinstance(e, NetworkError) and not isinstance(e, BadRequest):
+                self.network_failures += 1
+            if not request.future.done():
+                request.future.set_exception(e)
+            return
+        
+        self.network_failures = 0
+        self._sent += 1
+        OUTBOUND_REQUESTS_TOTAL.inc(result="sent")
+        if not request.future.done():
+            request.future.set_result(result)
+    
+    async def close(self) -> None:
+        """Stop dispatching and cancel requests that never went out."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for request in self._pending:
+            request.future.cancel()
+        self._pending.clear()
+    
+    def backlog(self) -> int:
+        """Return how many requests are waiting for budget."""
+        return len(self._pending)
+    
+    def stats(self) -> dict:
+        """Return queue depth, tracked chats and outcome counters."""
+        return {
+            "pending": len(self._pending),
+            "chats": len(self._chats),
+            "sent": self._sent,
+            "superseded": self._superseded,
+            "retried": self._retried,
+            "network_failures": self.network_failures
+        }
+
+outbound = OutboundSender(
+    OUTBOUND_CONFIG["global"],
+    OUTBOUND_CONFIG["private"],
+    OUTBOUND_CONFIG["group"],
+    OUTBOUND_CONFIG["max_retries"],
+    OUTBOUND_CONFIG["idle_ttl"]
+)
+
+# Generation scheduler limits
+SCHEDULER_CONFIG = {
+    "global_limit": int(os.getenv("GENERATION_GLOBAL_LIMIT", "16")),
+    "per_user_limit": int(os.getenv("GENERATION_PER_USER_LIMIT", "2")),
+    "per_chat_limit": int(os.getenv("GENERATION_PER_CHAT_LIMIT", "4")),
+    "max_queue": int(os.getenv("GENERATION_MAX_QUEUE", "100")),
+    # Seconds of waiting that lift a request by one priority class
+    "aging": float(os.getenv("GENERATION_PRIORITY_AGING", "10")),
+    # Share of max_queue each class may fill before new work of that class is shed
+    "queue_share": {"private": 1.0, "generate": 1.0, "group": 0.8, "sample": 0.5, "prewarm": 0.0}
+}
+
+# Priority classes, most interactive first; prewarm never queues, it only takes idle slots
+PRIORITY_CLASSES = ("private", "generate", "group", "sample", "prewarm")
+
+class SchedulerBusy(Exception):
+    """Raised when the generation wait queue is full."""
+
+class GenerationScheduler:
+    """Admit generations under global, per-user and per-chat concurrency caps.
+    
+    Waiters are admitted by priority class, with waiting time aging them
+    towards the front so low classes cannot starve. When the queue fills,
+    the lowest class is shed first. User and chat caps count jobs: slots
+    sharing a token, like the variants of one album, count once.
+    """
+    
+    def __init__(self, global_limit: int, per_user_limit: int, per_chat_limit: int, max_queue: int,
+                 aging: float = 10.0, queue_share: Optional[dict] = None):
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self.per_chat_limit = per_chat_limit
+        self.max_queue = max_queue
+        self.aging = aging
+        self.queue_share = queue_share or {}
+        
+        self._active = 0
+        # user_id / chat_id -> {job token: slots held}
+        self._active_users = {}
+        self._active_chats = {}
+        # [future, user_id, chat_id, class index, enqueued at, job token]
+        self._waiters = []
+        
+        # Wait-time bookkeeping per class, recent samples kept for percentiles
+        self._classes = {
+            name: {"admitted": 0, "rejected": 0, "shed": 0, "wait_total": 0.0,
+                   "wait_max": 0.0, "recent": deque(maxlen=1000)}
+            for name in PRIORITY_CLASSES
+        }
+    
+    @staticmethod
+    def _under_cap(jobs: Optional[dict], token, limit: int) -> bool:
+        return jobs is None or token in jobs or len(jobs) < limit
+    
+    def _can_run(self, user_id: int, chat_id: int, token) -> bool:
+        return (
+            self._active < self.global_limit
+            and self._under_cap(self._active_users.get(user_id), token, self.per_user_limit)
+            and self._under_cap(self._active_chats.get(chat_id), token, self.per_chat_limit)
+        )
+    
+    def _acquire(self, user_id: int, chat_id: int, token) -> None:
+        self._active += 1
+        for active, key in ((self._active_users, user_id), (self._active_chats, chat_id)):
+            jobs = active.setdefault(key, {})
+            jobs[token] = jobs.get(token, 0) + 1
+    
+    def _release(self, user_id: int, chat_id: int, token) -> None:
+        self._active -= 1
+        for active, key in ((self._active_users, user_id), (self._active_chats, chat_id)):
+            jobs = active[key]
+            jobs[token] -= 1
+            if not jobs[token]:
+                del jobs[token]
+            if not jobs:
+                del active[key]
+        self._wake()
+    
+    def _runnable_waiter(self) -> bool:
+        return any(not w[0].done() and self._can_run(w[1], w[2], w[5]) for w in self._waiters)
+    
+    def _rank(self, waiter: list, now: float) -> tuple:
+        # Lower ranks run first, every `aging` seconds waited is worth one class
+        return (waiter[3] - (now - waiter[4]) / self.aging, waiter[4])
+    
+    def _wake(self) -> None:
+        # Admit waiters by aged priority, skipping any whose user or chat is still at its cap
+        now = time.monotonic()
+        for waiter in sorted(self._waiters, key=lambda w: self._rank(w, now)):
+            if self._active >= self.global_limit:
+                break
+            future, user_id, chat_id, token = waiter[0], waiter[1], waiter[2], waiter[5]
+            if future.done():
+                self._waiters.remove(waiter)
+            elif self._can_run(user_id, chat_id, token):
+                self._waiters.remove(waiter)
+                self._acquire(user_id, chat_id, token)
+                future.set_result(None)
+    
+    def _make_room(self, priority: int) -> bool:
+        """Shed the lowest-ranked waiter below priority, returning whether one was shed."""
+        now = time.monotonic()
+        lower = [w for w in self._waiters if w[3] > priority and not w[0].done()]
+        if not lower:
+            return False
+        victim = max(lower, key=lambda w: self._rank(w, now))
+        self._waiters.remove(victim)
+        self._classes[PRIORITY_CLASSES[victim[3]]]["shed"] += 1
+        victim[0].set_exception(SchedulerBusy())
+        return True
+    
+    def _record_wait(self, priority: str, waited: float) -> None:
+        QUEUE_WAIT_SECONDS.observe(waited, priority=priority)
+        stats = self._classes[priority]
+        stats["admitted"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+        stats["recent"].append(waited)
+    
+    @asynccontextmanager
+    async def slot(self, user_id: int, chat_id: int, priority: str = "generate", token=None):
+        """Hold a generation slot, waiting in the bounded queue if needed.
+        
+        Slots given the same token belong to one job and count once against
+        the user and chat caps; without one every slot is its own job.
+        """
+        start = time.monotonic()
+        rank = PRIORITY_CLASSES.index(priority)
+        if token is None:
+            token = object()
+        
+        # Waiters still queued here are held by their own user or chat caps, or by the
+        # global limit; none of that should hold up a request that can run now
+        if self._can_run(user_id, chat_id, token) and not self._runnable_waiter():
+            self._acquire(user_id, chat_id, token)
+        else:
+            # Low classes stop queueing early; a full queue sheds lower work for higher
+            share = self.queue_share.get(priority, 1.0)
+            if (share < 1.0 and len(self._waiters) >= self.max_queue * share) or (
+                len(self._waiters) >= self.max_queue and not self._make_room(rank)
+            ):
+                self._classes[priority]["rejected"] += 1
+                raise SchedulerBusy()
+            
+            future = asyncio.get_running_loop().create_future()
+            waiter = [future, user_id, chat_id, rank, start, token]
+            self._waiters.append(waiter)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    # The slot was granted just before cancellation, hand it on
+                    self._release(user_id, chat_id, token)
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        
+        self._record_wait(priority, time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release(user_id, chat_id, token)
+    
+    def is_idle(self, share: float) -> bool:
+        """Return whether nobody is waiting and under share of the global slots are busy."""
+        return not self._waiters and self._active < self.global_limit * share
+    
+    def position(self, token) -> Optional[int]:
+        """Return how many waiters run before the first slot of this job token, or None if none is waiting."""
+        now = time.monotonic()
+        for ahead, waiter in enumerate(sorted(self._waiters, key=lambda w: self._rank(w, now))):
+            if waiter[5] is token and not waiter[0].done():
+                return ahead
+        return None
+    
+    def queue_fill(self) -> float:
+        """Return the waiting queue's length as a fraction of max_queue."""
+        return len(self._waiters) / self.max_queue if self.max_queue else 1.0
+    
+    def stats(self) -> dict:
+        """Return occupancy plus queue depth and wait-time statistics per class."""
+        depths = {name: 0 for name in PRIORITY_CLASSES}
+        for waiter in self._waiters:
+            depths[PRIORITY_CLASSES[waiter[3]]] += 1
+        
+        stats = {"active": self._active, "queue_depth": len(self._waiters)}
+        for name, counters in self._classes.items():
+            recent = sorted(counters["recent"])
+            admitted = counters["admitted"]
+            stats.update({
+                f"{name}_queue_depth": depths[name],
+                f"{name}_admitted": admitted,
+                f"{name}_rejected": counters["rejected"],
+                f"{name}_shed": counters["shed"],
+                f"{name}_wait_avg": counters["wait_total"] / admitted if admitted else 0.0,
+                f"{name}_wait_p95": recent[int(len(recent) * 0.95)] if recent else 0.0,
+                f"{name}_wait_max": counters["wait_max"]
+            })
+        return stats
+
+generation_scheduler = GenerationScheduler(**SCHEDULER_CONFIG)
+
+# Image result cache configuration
+IMAGE_CACHE_CONFIG = {
+    "memory_bytes": int(os.getenv("IMAGE_CACHE_MEMORY_MB", "64")) * 1024 * 1024,
+    "disk_dir": os.getenv("IMAGE_CACHE_DIR", ".cache/images"),
+    "disk_bytes": int(os.getenv("IMAGE_CACHE_DISK_MB", "512")) * 1024 * 1024,
+    "ttl": float(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600))),
+    # Seconds a random-seed request may reuse a recent result, 0 disables
+    "reuse_recent": float(os.getenv("IMAGE_CACHE_REUSE_RECENT", "0"))
+}
+
+class ImageCache:
+    """Two-tier (memory LRU + disk) cache of generated images keyed by request."""
+    
+    def __init__(self, memory_bytes: int, disk_dir: str, disk_bytes: int, ttl: float, reuse_recent: float):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.reuse_recent = reuse_recent
+        
+        # key -> (image bytes, stored_at)
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # key -> (file size, stored_at), loaded from disk on first use
+        self._disk = None
+        self._disk_size = 0
+        self._disk_lock = threading.Lock()
+        # (prompt, model, width, height) -> (key, stored_at) for random-seed reuse
+        self._recent = OrderedDict()
+        
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "expirations": 0
+        }
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.img")
+    
+    def _load_disk_index(self) -> None:
+        # Rebuild the LRU order from file modification times
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        os.makedirs(self.disk_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".img"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._disk[key] = (size, mtime)
+            self._disk_size += size
+    
+    def _remember(self, key: str, data: bytes, stored_at: float) -> None:
+        if len(data) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key)[0])
+        self._memory[key] = (data, stored_at)
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, (old, _) = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+            self.counters["memory_evictions"] += 1
+    
+    def _disk_get(self, key: str) -> Optional[tuple]:
+        with self._disk_lock:
+            return self._disk_get_locked(key)
+    
+    def _disk_get_locked(self, key: str) -> Optional[tuple]:
+        if self._disk is None:
+            self._load_disk_index()
+        entry = self._disk.get(key)
+        if entry is None:
+            return None
+        size, stored_at = entry
+        if time.time() - stored_at > self.ttl:
+            self._disk_drop(key)
+            self.counters["expirations"] += 1
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            self._disk_drop(key)
+            return None
+        self._disk.move_to_end(key)
+        return data, stored_at
+    
+    def _disk_put(self, key: str, data: bytes, stored_at: float) -> None:
+        with self._disk_lock:
+            self._disk_put_locked(key, data, stored_at)
+    
+    def _disk_put_locked(self, key: str, data: bytes, stored_at: float) -> None:
+        if self._disk is None:
+            self._load_disk_index()
+        if len(data) > self.disk_bytes:
+            return
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        if key in self._disk:
+            self._disk_size -= self._disk.pop(key)[0]
+        self._disk[key] = (len(data), stored_at)
+        self._disk_size += len(data)
+        while self._disk_size > self.disk_bytes:
+            old_key = next(iter(self._disk))
+            self._disk_drop(old_key)
+            self.counters["disk_evictions"] += 1
+    
+    def _disk_drop(self, key: str) -> None:
+        size, _ = self._disk.pop(key)
+        self._disk_size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        """Return cached image bytes for key, or None."""
+        entry = self._memory.get(key)
+        if entry is not None:
+            data, stored_at = entry
+            if time.time() - stored_at <= self.ttl:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return data
+            self._memory_size -= len(self._memory.pop(key)[0])
+            self.counters["expirations"] += 1
+        
+        try:
+            entry = await asyncio.to_thread(self._disk_get, key)
+        except Exception as e:
+            logger.error(f"Image cache read failed: {e}")
+            entry = None
+        
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        
+        data, stored_at = entry
+        self._remember(key, data, stored_at)
+        self.counters["disk_hits"] += 1
+        return data
+    
+    async def put(self, key: str, data: bytes) -> None:
+        """Store image bytes in both tiers."""
+        stored_at = time.time()
+        self._remember(key, data, stored_at)
+        try:
+            await asyncio.to_thread(self._disk_put, key, data, stored_at)
+        except Exception as e:
+            logger.error(f"Image cache write failed: {e}")
+    
+    def recent_key(self, alias: str) -> Optional[str]:
+        """Return a recently generated key for a random-seed request, if reuse is allowed."""
+        if self.reuse_recent <= 0:
+            return None
+        entry = self._recent.get(alias)
+        if entry is None:
+            return None
+        key, stored_at = entry
+        if time.time() - stored_at > self.reuse_recent:
+            del self._recent[alias]
+            return None
+        return key
+    
+    def remember_recent(self, alias: str, key: str) -> None:
+        """Record key as the latest random-seed result for the seedless request alias."""
+        if self.reuse_recent <= 0:
+            return
+        self._recent.pop(alias, None)
+        self._recent[alias] = (key, time.time())
+        while len(self._recent) > 10000:
+            self._recent.popitem(last=False)
+    
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters and tier sizes."""
+        return {
+            **self.counters,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "disk_entries": len(self._disk or ()),
+            "disk_bytes": self._disk_size
+        }
+
+image_cache = ImageCache(**IMAGE_CACHE_CONFIG)
+
+# Telegram file_id cache configuration
+FILE_ID_CACHE_CONFIG = {
+    "path": os.getenv("FILE_ID_CACHE_PATH", ".cache/file_ids.json"),
+    "max_entries": int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", "100000")),
+    "flush_interval": float(os.getenv("FILE_ID_CACHE_FLUSH_INTERVAL", "60"))
+}
+
+class FileIdCache:
+    """Persistent mapping from image cache keys and photo URLs to Telegram file_ids."""
+    
+    def __init__(self, path: str, max_entries: int, flush_interval: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self._ids = None
+        self._dirty = False
+    
+    def _load(self) -> None:
+        self._ids = OrderedDict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._ids.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Failed to load file_id cache: {e}")
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the file_id stored for key, if any."""
+        if self._ids is None:
+            self._load()
+        file_id = self._ids.get(key)
+        if file_id is not None:
+            self._ids.move_to_end(key)
+        return file_id
+    
+    def set(self, key: str, file_id: str) -> None:
+        """Remember the file_id Telegram assigned to key."""
+        if self._ids is None:
+            self._load()
+        if self._ids.get(key) == file_id:
+            return
+        self._ids[key] = file_id
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+        self._dirty = True
+    
+    def discard(self, key: str) -> None:
+        """Forget a file_id that Telegram rejected."""
+        if self._ids is not None and self._ids.pop(key, None) is not None:
+            self._dirty = True
+    
+    def _write(self, snapshot: dict) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+    
+    async def flush(self) -> None:
+        """Write pending changes to disk."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            await asyncio.to_thread(self._write, dict(self._ids))
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"Failed to save file_id cache: {e}")
+
+file_id_cache = FileIdCache(**FILE_ID_CACHE_CONFIG)
+
+# BadRequest descriptions that mean the file_id itself is no good; anything
+# else (caption, parse mode, chat) would fail the same way with fresh bytes
+FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference expired",
+                  "file_id", "wrong type of the web page content")
+
+class StaleFileId(Exception):
+    """Raised when a cached file_id was rejected and its image is no longer cached either."""
+
+def is_file_id_error(error: BadRequest) -> bool:
+    """Return whether Telegram rejected a request because of the file_id it carried."""
+    message = str(error).lower()
+    return any(marker in message for marker in FILE_ID_ERRORS)
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key."""
+    
+    def __init__(self):
+        self._flights = {}
+        # task -> callers still awaiting it
+        self._waiting = {}
+        self.counters = {
+            "leaders": 0,
+            "coalesced": 0
+        }
+    
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        # Retrieve the outcome so abandoned flights don't warn about lost exceptions
+        if not task.cancelled():
+            task.exception()
+    
+    async def do(self, key: str, func, *args):
+        """Await func(*args), joining an identical call that is already running."""
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._flights[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+            self.counters["leaders"] += 1
+        else:
+            self.counters["coalesced"] += 1
+        
+        # Shield so one impatient caller can't cancel the result for everyone else
+        self._waiting[task] = self._waiting.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiting[task] -= 1
+            if not self._waiting[task]:
+                del self._waiting[task]
+                # Every caller gave up, e.g. at shutdown, so stop the work too
+                if not task.done():
+                    task.cancel()
+    
+    def stats(self) -> dict:
+        """Return leader/coalesced counters and the number of open flights."""
+        return {**self.counters, "in_flight": len(self._flights)}
+
+image_flights = SingleFlight()
+
+# Default generation parameters
+DEFAULT_PARAMS = {
+    "width": 1024,
+    "height": 1024,
+    "seed": None,
+    "model": "flux"
+}
+
+# Multi-variant generation: /generate x2..x4 and the sample album button
+VARIANT_CONFIG = {
+    "options": {"x2": 2, "x3": 3, "x4": 4},
+    "sample_album": 4
+}
+
+# Callback buttons that start generations, with their rate limit cost
+GENERATION_CALLBACKS = {
+    "sample": 1,
+    "random_prompt": 1,
+    "sample_album": VARIANT_CONFIG["sample_album"]
+}
+RATE_LIMITED_TOAST = "Slow down a little, try again in a moment 🌸"
+
+# Compact setting codes. These are persisted, so only ever append to them
+MODEL_CODES = ["flux", "turbo", "flux-realism", "flux-anime"]
+SIZE_CODES = [(1024, 1024), (512, 512), (768, 768), (1024, 768), (512, 768), (768, 512)]
+STYLE_CODES = [None, "anime", "realistic", "fantasy", "cyberpunk", "cartoon",
+               "oil_painting", "watercolor", "digital_art", "vintage", "minimalist"]
+
+class UserSettings:
+    """A user's model, size and style packed into one small integer.
+    
+    Code 0 is the default (FLUX, 1024x1024, no style), so users who never
+    change anything cost no storage at all.
+    """
+    
+    __slots__ = ("code",)
+    
+    def __init__(self, code: int = 0):
+        self.code = code
+    
+    @classmethod
+    def pack(cls, model: str, size: tuple, style: Optional[str]) -> "UserSettings":
+        return cls(
+            MODEL_CODES.index(model)
+            | SIZE_CODES.index(size) << 8
+            | STYLE_CODES.index(style) << 16
+        )
+    
+    @property
+    def model(self) -> str:
+        return MODEL_CODES[self.code & 0xFF]
+    
+    @property
+    def size(self) -> tuple:
+        return SIZE_CODES[self.code >> 8 & 0xFF]
+    
+    @property
+    def width(self) -> int:
+        return self.size[0]
+    
+    @property
+    def height(self) -> int:
+        return self.size[1]
+    
+    @property
+    def style(self) -> Optional[str]:
+        return STYLE_CODES[self.code >> 16 & 0xFF]
+    
+    @property
+    def style_suffix(self) -> str:
+        return STYLE_PRESETS.get(self.style, "") if self.style else ""
+    
+    def replace(self, model: Optional[str] = None, size: Optional[tuple] = None,
+                style: Optional[str] = "") -> "UserSettings":
+        """Return a copy with the given fields changed (style=None clears it)."""
+        return UserSettings.pack(
+            model or self.model,
+            size or self.size,
+            self.style if style == "" else style
+        )
+    
+
+# Quality modifiers sent upstream with every prompt
+QUALITY_SUFFIX = "detailed, high quality, 8k"
+
+class PromptSpec:
+    """Everything that decides a generated image, with one canonical form.
+    
+    The canonical serialization builds the upstream URL and the cache and
+    coalescing keys, while the user's own text is kept for captions.
+    """
+    
+    __slots__ = ("text", "style", "quality", "model", "width", "height", "seed")
+    
+    def __init__(self, text: str, style: Optional[str] = None, quality: str = QUALITY_SUFFIX,
+                 model: str = DEFAULT_PARAMS["model"], width: int = DEFAULT_PARAMS["width"],
+                 height: int = DEFAULT_PARAMS["height"], seed: Optional[int] = None):
+        self.text = text
+        self.style = style
+        self.quality = quality
+        self.model = model
+        self.width = width
+        self.height = height
+        self.seed = seed
+    
+    @classmethod
+    def from_settings(cls, text: str, settings: UserSettings, seed: Optional[int] = None) -> "PromptSpec":
+        return cls(text, settings.style, model=settings.model, width=settings.width,
+                   height=settings.height, seed=seed)
+    
+    def replace(self, **changes) -> "PromptSpec":
+        """Return a copy with the given fields changed."""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return PromptSpec(**fields)
+    
+    @property
+    def model_param(self) -> str:
+        return API_SERVICE["models"].get(self.model, {}).get("model_param", "flux")
+    
+    @property
+    def upstream_prompt(self) -> str:
+        """User text with whitespace and case folded, then the style and quality modifiers."""
+        parts = (
+            " ".join(self.text.split()).casefold(),
+            STYLE_PRESETS.get(self.style, "") if self.style else "",
+            self.quality
+        )
+        return ", ".join(part for part in parts if part)
+    
+    def canonical(self) -> str:
+        """Serialize every field that reaches upstream, a missing seed as 'random'."""
+        seed = "random" if self.seed is None else str(self.seed)
+        return "\x1f".join((self.upstream_prompt, self.model_param, str(self.width), str(self.height), seed))
+    
+    @property
+    def key(self) -> str:
+        """Content address for the cache and for coalescing identical requests."""
+        return hashlib.sha256(self.canonical().encode("utf-8")).hexdigest()
+    
+    def url(self) -> str:
+        """Build the Pollinations URL for a spec with a concrete seed."""
+        return API_SERVICE["url"].format(
+            prompt=quote(self.upstream_prompt, safe=""),
+            width=self.width,
+            height=self.height,
+            seed=self.seed,
+            model=self.model_param
+        )
+    
+    def caption(self, template: str, user_name: str, **fields) -> str:
+        """Render a caption template around the user's own prompt text."""
+        return template.format(user_name=user_name, prompt=html.escape(self.text.strip()), **fields)
+
+# User settings persistence configuration
+SETTINGS_CONFIG = {
+    "path": os.getenv("SETTINGS_DB_PATH", ".cache/settings.db"),
+    "cache_size": int(os.getenv("SETTINGS_CACHE_SIZE", "50000")),
+    "flush_interval": float(os.getenv("SETTINGS_FLUSH_INTERVAL", "5"))
+}
+
+class SettingsBackend:
+    """Storage interface for packed user settings codes."""
+    
+    def load(self, user_id: int) -> Optional[int]:
+        raise NotImplementedError
+    
+    def save_many(self, rows: list) -> None:
+        """Persist (user_id, code) pairs, code 0 removes the row."""
+        raise NotImplementedError
+    
+    def close(self) -> None:
+        pass
+
+class SQLiteSettingsBackend(SettingsBackend):
+    """SQLite settings storage in WAL mode, one integer row per customised user."""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_settings "
+                "(user_id INTEGER PRIMARY KEY, code INTEGER NOT NULL)"
+            )
+        return self._conn
+    
+    def load(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT code FROM user_settings WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def save_many(self, rows: list) -> None:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO user_settings (user_id, code) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET code = excluded.code",
+                    [row for row in rows if row[1]]
+                )
+                conn.executemany(
+                    "DELETE FROM user_settings WHERE user_id = ?",
+                    [(user_id,) for user_id, code in rows if not code]
+                )
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class SettingsStore:
+    """Lazily loaded, LRU-cached user settings with write-behind batching."""
+    
+    def __init__(self, backend: SettingsBackend, cache_size: int, flush_interval: float):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        # user_id -> code, bounded so RSS tracks active rather than total users
+        self._cache = OrderedDict()
+        # user_id -> code waiting to be written
+        self._dirty = {}
+    
+    def _remember(self, user_id: int, code: int) -> None:
+        self._cache[user_id] = code
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    async def get(self, user_id: int) -> UserSettings:
+        """Return a user's settings, reading storage only on first touch."""
+        code = self._dirty.get(user_id)
+        if code is None:
+            code = self._cache.get(user_id)
+        if code is None:
+            try:
+                code = await asyncio.to_thread(self.backend.load, user_id) or 0
+            except Exception as e:
+                logger.error(f"Failed to load settings for {user_id}: {e}")
+                code = 0
+            # A concurrent set() may have landed while we were reading
+            code = self._dirty.get(user_id, code)
+        self._remember(user_id, code)
+        return UserSettings(code)
+    
+    def set(self, user_id: int, settings: UserSettings) -> None:
+        """Update a user's settings, the write is batched into the next flush."""
+        self._remember(user_id, settings.code)
+        self._dirty[user_id] = settings.code
+    
+    async def flush(self) -> None:
+        """Write all pending changes in one transaction."""
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self.backend.save_many, list(pending.items()))
+        except Exception as e:
+            logger.error(f"Failed to save {len(pending)} user settings: {e}")
+            # Keep newer changes made during the failed write
+            self._dirty = {**pending, **self._dirty}
+
+settings_store = SettingsStore(
+    SQLiteSettingsBackend(SETTINGS_CONFIG["path"]),
+    SETTINGS_CONFIG["cache_size"],
+    SETTINGS_CONFIG["flush_interval"]
+)
+
+# Shared generation job queue used between ingress and worker processes
+GENERATION_QUEUE_CONFIG = {
+    "backend": os.getenv("GENERATION_QUEUE_BACKEND", "sqlite"),
+    "path": os.getenv("GENERATION_QUEUE_PATH", ".cache/jobs.db"),
+    "poll_interval": float(os.getenv("GENERATION_QUEUE_POLL_INTERVAL", "0.2")),
+    # A claimed job is handed to another worker if not finished within the lease
+    "lease": float(os.getenv("GENERATION_QUEUE_LEASE", "300")),
+    # Workers only pull what they can run, so ingress bounds and orders the backlog
+    # with the scheduler's classes, aging and shares
+    "max_queue": int(os.getenv("GENERATION_QUEUE_MAX", str(SCHEDULER_CONFIG["max_queue"]))),
+    "aging": SCHEDULER_CONFIG["aging"],
+    "queue_share": SCHEDULER_CONFIG["queue_share"]
+}
+
+class GenerationQueue:
+    """Interface for the queue carrying generation jobs to workers.
+    
+    Jobs are claimed by aged priority class like scheduler waiters. put()
+    raises SchedulerBusy when the queue is full; a full queue instead marks
+    lower-class work as shed, which workers answer with the busy reply.
+    """
+    
+    def __init__(self, max_queue: int, aging: float, queue_share: dict):
+        self.max_queue = max_queue
+        self.aging = aging
+        self.queue_share = queue_share
+    
+    def _check_room(self, priority: str, pending: int, make_room) -> None:
+        # Same admission as GenerationScheduler.slot, make_room(rank) sheds one lower job
+        share = self.queue_share.get(priority, 1.0)
+        if (share < 1.0 and pending >= self.max_queue * share) or (
+            pending >= self.max_queue and not make_room(PRIORITY_CLASSES.index(priority))
+        ):
+            raise SchedulerBusy()
+    
+    async def put(self, job: dict) -> None:
+        raise NotImplementedError
+    
+    async def queue_fill(self) -> float:
+        """Return the unclaimed, unshed jobs as a fraction of max_queue."""
+        raise NotImplementedError
+    
+    async def get(self) -> dict:
+        """Wait for and claim the next job, shed ones carry "shed": True."""
+        raise NotImplementedError
+    
+    async def done(self, job: dict) -> None:
+        """Acknowledge a claimed job so it is not handed out again."""
+        raise NotImplementedError
+    
+    async def release(self, job: dict) -> None:
+        """Give up a claimed job so another worker can take it straight away."""
+        raise NotImplementedError
+
+class MemoryGenerationQueue(GenerationQueue):
+    """In-process queue, for running ingress and workers on one event loop."""
+    
+    def __init__(self, max_queue: int, aging: float, queue_share: dict):
+        super().__init__(max_queue, aging, queue_share)
+        # [class index, enqueued at, job]
+        self._pending = []
+        self._available = asyncio.Semaphore(0)
+    
+    def _rank(self, entry: list, now: float) -> tuple:
+        return (entry[0] - (now - entry[1]) / self.aging, entry[1])
+    
+    def _make_room(self, rank: int) -> bool:
+        now = time.monotonic()
+        lower = [entry for entry in self._pending if entry[0] > rank and not entry[2].get("shed")]
+        if not lower:
+            return False
+        max(lower, key=lambda entry: self._rank(entry, now))[2]["shed"] = True
+        return True
+    
+    async def put(self, job: dict) -> None:
+        priority = job.get("priority", "generate")
+        pending = sum(1 for entry in self._pending if not entry[2].get("shed"))
+        self._check_room(priority, pending, self._make_room)
+        self._pending.append([PRIORITY_CLASSES.index(priority), time.monotonic(), job])
+        self._available.release()
+    
+    async def queue_fill(self) -> float:
+        pending = sum(1 for entry in self._pending if not entry[2].get("shed"))
+        return pending / self.max_queue if self.max_queue else 1.0
+    
+    async def get(self) -> dict:
+        await self._available.acquire()
+        now = time.monotonic()
+        # Shed jobs first, they only need their busy reply
+        entry = min(self._pending, key=lambda entry: (not entry[2].get("shed"), self._rank(entry, now)))
+        self._pending.remove(entry)
+        return entry[2]
+    
+    async def done(self, job: dict) -> None:
+        pass
+    
+    async def release(self, job: dict) -> None:
+        self._pending.append([PRIORITY_CLASSES.index(job.get("priority", "generate")), time.monotonic(), job])
+        self._available.release()
+
+class SQLiteGenerationQueue(GenerationQueue):
+    """Durable queue in a SQLite file shared by every process on the host."""
+    
+    def __init__(self, path: str, poll_interval: float, lease: float, max_queue: int, aging: float,
+                 queue_share: dict):
+        super().__init__(max_queue, aging, queue_share)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._conn = None
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, claimed_at REAL, "
+                "priority INTEGER NOT NULL DEFAULT 1, enqueued_at REAL NOT NULL DEFAULT 0, "
+                "shed INTEGER NOT NULL DEFAULT 0)"
+            )
+            # Queues created before priorities were stored
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column in ("priority INTEGER NOT NULL DEFAULT 1", "enqueued_at REAL NOT NULL DEFAULT 0",
+                           "shed INTEGER NOT NULL DEFAULT 0"):
+                if column.split()[0] not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+        return self._conn
+    
+    def _make_room(self, conn: sqlite3.Connection, rank: int, now: float) -> bool:
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE claimed_at IS NULL AND shed = 0 AND priority > ? "
+            "ORDER BY priority - (? - enqueued_at) / ? DESC, enqueued_at DESC LIMIT 1",
+            (rank, now, self.aging)
+        ).fetchone()
+        if row:
+            conn.execute("UPDATE jobs SET shed = 1 WHERE id = ?", (row[0],))
+        return row is not None
+    
+    def _pending(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE claimed_at IS NULL AND shed = 0").fetchone()[0]
+    
+    def _queue_fill(self) -> float:
+        with self._lock:
+            pending = self._pending(self._connect())
+        return pending / self.max_queue if self.max_queue else 1.0
+    
+    def _put(self, job: dict) -> None:
+        priority = job.get("priority", "generate")
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                pending = self._pending(conn)
+                self._check_room(priority, pending, lambda rank: self._make_room(conn, rank, now))
+                conn.execute(
+                    "INSERT INTO jobs (payload, priority, enqueued_at) VALUES (?, ?, ?)",
+                    (json.dumps(job), PRIORITY_CLASSES.index(priority), now)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    
+    def _claim(self) -> Optional[dict]:
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Shed jobs first, they only need their busy reply; then by aged priority
+                row = conn.execute(
+                    "SELECT id, payload, shed FROM jobs WHERE claimed_at IS NULL OR claimed_at < ? "
+                    "ORDER BY shed DESC, priority - (? - enqueued_at) / ?, id LIMIT 1",
+                    (now - self.lease, now, self.aging)
+                ).fetchone()
+                if row:
+                    conn.execute("UPDATE jobs SET claimed_at = ? WHERE id = ?", (now, row[0]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        job = json.loads(row[1])
+        job["queue_id"] = row[0]
+        if row[2]:
+            job["shed"] = True
+        return job
+    
+    def _done(self, queue_id: int) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM jobs WHERE id = ?", (queue_id,))
+    
+    def _release(self, queue_id: int) -> None:
+        with self._lock:
+            self._connect().execute("UPDATE jobs SET claimed_at = NULL WHERE id = ?", (queue_id,))
+    
+    async def put(self, job: dict) -> None:
+        await asyncio.to_thread(self._put, job)
+    
+    async def queue_fill(self) -> float:
+        return await asyncio.to_thread(self._queue_fill)
+    
+    async def get(self) -> dict:
+        while True:
+            # Cancelling cannot stop the thread, a row it still claims goes straight back
+            claim = asyncio.ensure_future(asyncio.to_thread(self._claim))
+            try:
+                job = await asyncio.shield(claim)
+            except asyncio.CancelledError:
+                job = await claim
+                if job is not None:
+                    await self.release(job)
+                raise
+            if job is not None:
+                return job
+            await asyncio.sleep(self.poll_interval)
+    
+    async def done(self, job: dict) -> None:
+        await asyncio.to_thread(self._done, job["queue_id"])
+    
+    async def release(self, job: dict) -> None:
+        await asyncio.to_thread(self._release, job["queue_id"])
+
+def create_generation_queue(backend: str, path: str, poll_interval: float, lease: float, max_queue: int,
+                            aging: float, queue_share: dict) -> GenerationQueue:
+    """Build the configured generation queue backend."""
+    if backend == "memory":
+        return MemoryGenerationQueue(max_queue, aging, queue_share)
+    return SQLiteGenerationQueue(path, poll_interval, lease, max_queue, aging, queue_share)
+
+generation_queue = create_generation_queue(**GENERATION_QUEUE_CONFIG)
+
+# Journal of generations run in this process, for resuming after a restart
+JOURNAL_CONFIG = {
+    "path": os.getenv("JOB_JOURNAL_PATH", ".cache/journal.db"),
+    # Seconds shutdown waits for in-flight generations before journaling them
+    "deadline": float(os.getenv("DRAIN_DEADLINE", "25")),
+    # Journaled jobs older than this are reported as failed instead of resumed
+    "max_age": float(os.getenv("JOB_JOURNAL_MAX_AGE", "3600"))
+}
+
+class JobJournal:
+    """Write-ahead SQLite record of generation jobs not yet delivered."""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL)"
+            )
+        return self._conn
+    
+    def _add(self, job: dict) -> int:
+        with self._lock:
+            return self._connect().execute("INSERT INTO journal (payload) VALUES (?)", (json.dumps(job),)).lastrowid
+    
+    def _remove(self, journal_id: int) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM journal WHERE id = ?", (journal_id,))
+    
+    def _pending(self) -> list:
+        with self._lock:
+            rows = self._connect().execute("SELECT id, payload FROM journal ORDER BY id").fetchall()
+        return [{**json.loads(payload), "journal_id": journal_id} for journal_id, payload in rows]
+    
+    async def add(self, job: dict) -> int:
+        return await asyncio.to_thread(self._add, job)
+    
+    async def remove(self, journal_id: int) -> None:
+        await asyncio.to_thread(self._remove, journal_id)
+    
+    async def pending(self) -> list:
+        """Return journaled jobs, oldest first, each with its journal_id."""
+        return await asyncio.to_thread(self._pending)
+    
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class InflightJobs:
+    """Track running generations so shutdown can drain them within a deadline.
+    
+    Jobs are journaled before they start and removed once their status
+    message has its outcome, so anything cut off by the deadline, or by a
+    crash, is resumed on the next start.
+    """
+    
+    def __init__(self, journal: JobJournal, deadline: float, max_age: float):
+        self.journal = journal
+        self.deadline = deadline
+        self.max_age = max_age
+        self.draining = False
+        self._tasks = set()
+        self.counters = {"drained": 0, "journaled": 0, "resumed": 0, "expired": 0}
+    
+    @asynccontextmanager
+    async def track(self):
+        """Mark the current task as running a generation."""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            yield
+        finally:
+            self._tasks.discard(task)
+    
+    def is_tracked(self, task: asyncio.Task) -> bool:
+        return task in self._tasks
+    
+    async def run(self, bot, job: dict) -> None:
+        """Run a job under the journal, or only journal it once draining has begun."""
+        if "journal_id" not in job:
+            job["journal_id"] = await self.journal.add(job)
+        if self.draining:
+            self.counters["journaled"] += 1
+            return
+        async with self.track():
+            await run_generation_job(bot, job)
+        await self.journal.remove(job["journal_id"])
+    
+    async def drain(self) -> None:
+        """Stop starting jobs, wait up to the deadline and cancel what is left."""
+        self.draining = True
+        tasks = set(self._tasks)
+        if not tasks:
+            return
+        logger.info(f"Draining {len(tasks)} in-flight generations for up to {self.deadline:.0f}s")
+        done, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        self.counters["drained"] += len(done)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            self.counters["journaled"] += len(pending)
+            logger.warning(f"{len(pending)} generations did not finish, they resume after restart")
+    
+    async def resume(self, bot) -> None:
+        """Accept jobs again and finish journaled ones in their original status messages."""
+        self.draining = False
+        jobs = await self.journal.pending()
+        if not jobs:
+            return
+        logger.info(f"Resuming {len(jobs)} journaled generations")
+        
+        async def resume_job(job: dict) -> None:
+            if time.time() - job["created_at"] > self.max_age:
+                self.counters["expired"] += 1
+                try:
+                    await edit_job_status(bot, job, ERROR_MESSAGES["generation_failed"].format(user_name=job["mention"]))
+                except Exception as e:
+                    logger.warning(f"Could not report expired job in chat {job['chat_id']}: {e}")
+                await self.journal.remove(job["journal_id"])
+                return
+            self.counters["resumed"] += 1
+            await self.run(bot, job)
+        
+        await asyncio.gather(*(resume_job(job) for job in jobs), return_exceptions=True)
+    
+    def stats(self) -> dict:
+        return {**self.counters, "running": len(self._tasks)}
+
+inflight_jobs = InflightJobs(JobJournal(JOURNAL_CONFIG["path"]), JOURNAL_CONFIG["deadline"], JOURNAL_CONFIG["max_age"])
+
+# Background generation into idle upstream capacity
+PREWARM_CONFIG = {
+    "enabled": os.getenv("PREWARM_ENABLED", "1") != "0",
+    "interval": float(os.getenv("PREWARM_INTERVAL", "30")),
+    # Generations started per tick, and the share of global slots that must be free
+    "batch": int(os.getenv("PREWARM_BATCH", "2")),
+    "idle_share": 0.5,
+    # Ready sample images kept for each of the most requested settings
+    "sample_pool": int(os.getenv("PREWARM_SAMPLE_POOL", "8")),
+    "sample_combos": 3,
+    # Learned user prompts kept ready once seen often enough
+    "frequent_prompts": int(os.getenv("PREWARM_FREQUENT_PROMPTS", "10")),
+    "frequent_min_count": 3,
+    "tracked_prompts": 1000,
+    "max_backoff": 8
+}
+
+class PrewarmPool:
+    """Ready images for seedless requests, generated while upstream is idle.
+    
+    Entries are seeded cache keys filed under the seedless PromptSpec key,
+    and each one is handed out once so repeated requests still see fresh
+    images. Targets are the sample prompts for the most requested
+    settings, then the user prompts seen most often.
+    """
+    
+    def __init__(self, batch: int, idle_share: float, sample_pool: int, sample_combos: int,
+                 frequent_prompts: int, frequent_min_count: int, tracked_prompts: int, max_backoff: int,
+                 enabled: bool = True, interval: float = 30.0):
+        self.batch = batch
+        self.idle_share = idle_share
+        self.sample_pool = sample_pool
+        self.sample_combos = sample_combos
+        self.frequent_prompts = frequent_prompts
+        self.frequent_min_count = frequent_min_count
+        self.tracked_prompts = tracked_prompts
+        self.max_backoff = max_backoff
+        self.enabled = enabled
+        self.interval = interval
+        
+        self.running = False
+        self._ready = {}
+        # settings code -> sample requests, seedless key -> [count, spec]
+        self._sample_demand = {}
+        self._prompts = {}
+        self._backoff = 1
+        self._skip_ticks = 0
+        self.counters = {"hits": 0, "generated": 0, "failed": 0, "backoffs": 0}
+    
+    def ready(self, alias: str) -> int:
+        return len(self._ready.get(alias, ()))
+    
+    def add(self, alias: str, key: str) -> None:
+        self._ready.setdefault(alias, deque()).append(key)
+    
+    def take(self, alias: str) -> Optional[str]:
+        """Hand out one ready cache key for a seedless request, if any."""
+        keys = self._ready.get(alias)
+        if not keys:
+            return None
+        key = keys.popleft()
+        if not keys:
+            del self._ready[alias]
+        self.counters["hits"] += 1
+        return key
+    
+    def pick_sample(self, settings: UserSettings) -> str:
+        """Choose a sample prompt, preferring one with an image ready for these settings."""
+        self._sample_demand[settings.code] = self._sample_demand.get(settings.code, 0) + 1
+        ready = [p for p in RANDOM_PROMPTS if self.ready(PromptSpec.from_settings(p, settings).key)]
+        return random.choice(ready or RANDOM_PROMPTS)
+    
+    def record_prompt(self, spec: PromptSpec) -> None:
+        """Count a user prompt so frequent ones can be generated ahead of time."""
+        if spec.seed is not None:
+            return
+        alias = spec.key
+        entry = self._prompts.get(alias)
+        if entry:
+            entry[0] += 1
+            return
+        if len(self._prompts) >= self.tracked_prompts:
+            # Halve every count so stale favourites fade and new prompts can get in
+            for key, entry in list(self._prompts.items()):
+                entry[0] //= 2
+                if not entry[0]:
+                    del self._prompts[key]
+            if len(self._prompts) >= self.tracked_prompts:
+                return
+        self._prompts[alias] = [1, spec]
+    
+    def targets(self) -> list:
+        """Seedless specs that need a ready image, most useful first."""
+        targets = []
+        combos = sorted(self._sample_demand, key=self._sample_demand.get, reverse=True)[:self.sample_combos]
+        for code in combos or [0]:
+            specs = [PromptSpec.from_settings(p, UserSettings(code)) for p in RANDOM_PROMPTS]
+            missing = self.sample_pool - sum(self.ready(spec.key) for spec in specs)
+            empty = [spec for spec in specs if not self.ready(spec.key)]
+            targets.extend(random.sample(empty, max(0, min(missing, len(empty)))))
+        
+        frequent = sorted(self._prompts.values(), key=lambda entry: entry[0], reverse=True)
+        for count, spec in frequent[:self.frequent_prompts]:
+            if count >= self.frequent_min_count and not self.ready(spec.key):
+                targets.append(spec)
+        return targets
+    
+    async def _generate(self, spec: PromptSpec) -> None:
+        seeded = spec.replace(seed=random.randint(1, 1000000))
+        # User and chat 0 keep prewarming within the per-user slot cap
+        async with generation_scheduler.slot(0, 0, "prewarm"):
+            image_bytes = await generate_image_pollinations(seeded)
+        image_bytes = await postprocess_image(image_bytes)
+        await image_cache.put(seeded.key, image_bytes)
+        self.add(spec.key, seeded.key)
+        self.counters["generated"] += 1
+    
+    async def refill(self) -> None:
+        """Generate one batch of missing images, backing off while real work is waiting."""
+        if self._skip_ticks:
+            self._skip_ticks -= 1
+            return
+        if not generation_scheduler.is_idle(self.idle_share) or upstream_breaker.state != CircuitBreaker.CLOSED:
+            self.counters["backoffs"] += 1
+            self._skip_ticks = self._backoff
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            return
+        self._backoff = 1
+        
+        targets = self.targets()[:self.batch]
+        if not targets:
+            return
+        self.running = True
+        try:
+            results = await asyncio.gather(*(self._generate(spec) for spec in targets), return_exceptions=True)
+        finally:
+            self.running = False
+        for result in results:
+            if isinstance(result, Exception):
+                self.counters["failed"] += 1
+                logger.debug(f"Prewarm generation skipped: {result}")
+    
+    def stats(self) -> dict:
+        """Return ready images, tracked prompts and counters."""
+        return {
+            **self.counters,
+            "ready": sum(len(keys) for keys in self._ready.values()),
+            "tracked_prompts": len(self._prompts)
+        }
+
+prewarm_pool = PrewarmPool(**PREWARM_CONFIG)
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /start command with random photo."""
+    # Get user's clickable mention
+    user_mention = get_clickable_user_mention(update.effective_user)
+    
+    # Select random photo
+    random_photo = random.choice(RANDOM_PHOTOS)
+    
+    # Determine message based on chat type
+    if update.effective_chat.type == 'private':
+        welcome_message = WELCOME_MESSAGES["private"].format(user_name=user_mention)
+    else:
+        welcome_message = WELCOME_MESSAGES["group"].format(user_name=user_mention)
+    
+    # Keyboard with dynamic links
+    reply_markup = start_keyboard(context.bot.username)
+    
+    # Send the photo, reusing Telegram's file_id once it has fetched the URL
+    file_id = file_id_cache.get(random_photo)
+    try:
+        message = await update.message.reply_photo(
+            photo=file_id or random_photo,
+            caption=welcome_message,
+            parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup
+        )
+    except BadRequest as e:
+        if not file_id or not is_file_id_error(e):
+            raise
+        file_id_cache.discard(random_photo)
+        message = await update.message.reply_photo(
+            photo=random_photo,
+            caption=welcome_message,
+            parse_mode=ParseMode.HTML,
+            reply_markup=reply_markup
+        )
+    
+    if message.photo:
+        file_id_cache.set(random_photo, message.photo[-1].file_id)
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /help command."""
+    # Get user's clickable mention
+    user_mention = get_clickable_user_mention(update.effective_user)
+    
+    await update.message.reply_text(
+        HELP_MESSAGES["basic"].format(user_name=user_mention), 
+        parse_mode=ParseMode.HTML, 
+        reply_markup=KEYBOARDS["expand_guide"]
+    )
+
+async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /generate command with all functionality."""
+    # Get user's clickable mention
+    user_mention = get_clickable_user_mention(update.effective_user)
     
     if not context.args:
         # Show generate menu with options
-        keyboard = [
-            [
-                InlineKeyboardButton("🤖 Select Model", callback_data="select_model"),
-                InlineKeyboardButton("🎨 Generate Sample", callback_data="sample")
-            ],
-            [
-                InlineKeyboardButton("⚙️ Settings", callback_data="settings_menu"),
-                InlineKeyboardButton("❓ Help", callback_data="help_menu")
-            ],
-            [
-                InlineKeyboardButton("🌟 Style Presets", callback_data="style_presets"),
-                InlineKeyboardButton("🎲 Random Prompt", callback_data="random_prompt")
-            ],
-            [
-                InlineKeyboardButton("📊 Image Sizes", callback_data="size_options"),
-                InlineKeyboardButton("🔄 Reset Settings", callback_data="reset_settings")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
             MENU_MESSAGES["generate_menu"].format(user_name=user_mention),
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=KEYBOARDS["generate_menu"]
+        )
+        return
+    
+    # A leading x2..x4 asks for several seeds of the same prompt
+    args = context.args
+    variants = VARIANT_CONFIG["options"].get(args[0].lower(), 1)
+    if variants > 1:
+        args = args[1:]
+    if not args:
+        await update.message.reply_text(
+            ERROR_MESSAGES["no_prompt"].format(user_name=user_mention),
+            parse_mode=ParseMode.HTML
         )
         return
     
-    prompt = " ".join(context.args)
-    await generate_image(update, context, prompt)
+    # Variants cost one token each
+    if not await allow_generation(update, "generate", variants):
+        return
+    
+    prompt = " ".join(args)
+    await generate_image(update, context, prompt, variants)
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle regular text messages as image generation prompts."""
@@ -573,7 +3202,8 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         
     # Regular prompt generation (only in private chats)
     if update.effective_chat.type == 'private':
-        await generate_image(update, context, message_text)
+        if await allow_generation(update, "text"):
+            await generate_image(update, context, message_text, priority="private")
 
 async def handle_mikasa_keyword(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str) -> None:
     """Handle mikasa keyword in groups."""
@@ -585,141 +3215,349 @@ async def handle_mikasa_keyword(update: Update, context: ContextTypes.DEFAULT_TY
     
     if len(parts) == 1:
         # Only "mikasa" was said, no prompt
-        keyboard = [
-            [
-                InlineKeyboardButton("🗑️ Delete", callback_data="delete_message")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await update.message.reply_text(
             ERROR_MESSAGES["no_prompt"].format(user_name=user_mention),
             parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
+            reply_markup=KEYBOARDS["delete"]
         )
     else:
         # mikasa with prompt - generate image
         prompt = parts[1]
-        await generate_image_with_reply(update, context, prompt)
+        if await allow_generation(update, "text"):
+            await generate_image_with_reply(update, context, prompt)
 
 async def generate_image_with_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str) -> None:
     """Generate image and reply to the original message."""
-    # Get user's clickable mention
-    user_mention = get_clickable_user_mention(update.effective_user)
-    
-    user_settings = context.user_data.get('settings', DEFAULT_PARAMS.copy())
-    current_model = context.user_data.get('model', 'flux')
-    
-    # Update settings with current model
-    user_settings['model'] = current_model
-    
-    # Apply style suffix if available
-    style_suffix = context.user_data.get('style_suffix', '')
-    if style_suffix:
-        prompt = f"{prompt}, {style_suffix}"
+    created_at = time.time()
     
     # Send random status emoji
     status_emoji = random.choice(STATUS_MESSAGES["generating"])
-    status_message = await update.message.reply_text(status_emoji)
+    status_message = await outbound.send(
+        update.effective_chat.id,
+        functools.partial(update.message.reply_text, status_emoji),
+        OutboundSender.STATUS
+    )
     
+    # A keyword in a private chat is still someone waiting on a direct reply
+    priority = "private" if update.effective_chat.type == 'private' else "group"
+    await dispatch_generation(context.bot, make_generation_job(
+        update, status_message, prompt, "image_for_user", created_at, priority=priority
+    ))
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        image_bytes = await generate_image_pollinations(prompt, user_settings)
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the server asked for."""
+    delay = random.uniform(0, min(RESILIENCE_CONFIG["backoff_max"], RESILIENCE_CONFIG["backoff_base"] * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RESILIENCE_CONFIG["backoff_max"]))
+    return delay
+
+def hedge_delay() -> float:
+    """Return how long to wait for the first request before hedging."""
+    if RESILIENCE_CONFIG["hedge_delay"] > 0:
+        return RESILIENCE_CONFIG["hedge_delay"]
+    if len(recent_upstream_latencies) >= 20:
+        ordered = sorted(recent_upstream_latencies)
+        p95 = ordered[int(len(ordered) * 0.95)]
+    else:
+        p95 = HTTP_CONFIG["read_timeout"] / 2
+    return max(RESILIENCE_CONFIG["hedge_min_delay"], p95)
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Identify JPEG, PNG or WebP data from its first 12 bytes."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def image_is_complete(image_type: str, buffer: bytearray, size: int) -> bool:
+    """Cheap trailer check that catches bodies cut off mid-transfer."""
+    if image_type == "jpeg":
+        return b"\xff\xd9" in buffer[max(0, size - 64):size]
+    if image_type == "png":
+        return b"IEND" in buffer[max(0, size - 12):size]
+    return int.from_bytes(buffer[4:8], "little") + 8 <= size
+
+async def read_image_body(response: httpx.Response) -> bytes:
+    """Stream an image body into a bounded, preallocated buffer.
+    
+    The magic bytes are checked as soon as the first 12 bytes arrive, so an
+    HTML error page served with status 200 is rejected without reading it all.
+    """
+    max_bytes = HTTP_CONFIG["max_image_bytes"]
+    declared = 0
+    if "content-encoding" not in response.headers:
+        declared = int(response.headers.get("content-length") or 0)
+    if declared > max_bytes:
+        raise UpstreamInvalidImage(f"Pollinations image too large: {declared} bytes")
+    
+    buffer = bytearray(declared or 256 * 1024)
+    size = 0
+    image_type = None
+    
+    async for chunk in response.aiter_bytes():
+        end = size + len(chunk)
+        if end > max_bytes:
+            raise UpstreamInvalidImage(f"Pollinations image exceeds {max_bytes} bytes")
+        if end > len(buffer):
+            buffer.extend(bytes(max(end - len(buffer), len(buffer))))
+        buffer[size:end] = chunk
+        size = end
         
-        if image_bytes:
-            # Edit the emoji message with the generated image
-            image_stream = BytesIO(image_bytes)
-            
-            # Get clean prompt (remove style suffix for display)
-            clean_prompt = prompt
-            if context.user_data.get('style_suffix'):
-                clean_prompt = prompt.replace(', ' + context.user_data.get('style_suffix'), '')
-            
-            # Escape the prompt for HTML
-            escaped_prompt = html.escape(clean_prompt)
-            
-            caption = SUCCESS_MESSAGES["image_for_user"].format(
-                user_name=user_mention,
-                prompt=escaped_prompt
-            )
-            
-            await context.bot.edit_message_media(
-                chat_id=update.effective_chat.id,
-                message_id=status_message.message_id,
-                media=InputMediaPhoto(
-                    media=image_stream,
-                    caption=caption,
-                    parse_mode=ParseMode.HTML
-                )
-            )
-            
-        else:
-            # Generation failed - edit the emoji message with error
-            await status_message.edit_text(
-                ERROR_MESSAGES["generation_failed"].format(user_name=user_mention), 
-                parse_mode=ParseMode.HTML
-            )
-            
-    except Exception as e:
-        logger.error(f"Error generating image: {str(e)}")
-        try:
-            await status_message.edit_text(
-                ERROR_MESSAGES["generation_failed"].format(user_name=user_mention),
-                parse_mode=ParseMode.HTML
-            )
-        except Exception:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=ERROR_MESSAGES["generation_failed"].format(user_name=user_mention),
-                parse_mode=ParseMode.HTML
-            )
+        if image_type is None and size >= 12:
+            image_type = sniff_image_type(bytes(buffer[:12]))
+            if image_type is None:
+                raise UpstreamInvalidImage("Pollinations returned a non-image body")
+    
+    if image_type is None:
+        raise UpstreamInvalidImage(f"Pollinations returned only {size} bytes")
+    if (declared and size != declared) or not image_is_complete(image_type, buffer, size):
+        raise UpstreamInvalidImage("Pollinations image is truncated")
+    
+    # The one copy out of the buffer, BytesIO wraps the result without another
+    return bytes(memoryview(buffer)[:size])
 
-async def generate_image_pollinations(prompt: str, settings: dict) -> Optional[bytes]:
-    """Generate image using Pollinations AI."""
+async def request_pollinations(spec: PromptSpec) -> bytes:
+    """Make a single Pollinations request, raising UpstreamError on failure."""
+    GENERATIONS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    result = "network"
     try:
-        seed = settings.get('seed') or random.randint(1, 1000000)
-        model = settings.get('model', 'flux')
-        model_param = API_SERVICE["models"].get(model, {}).get('model_param', 'flux')
-        
-        # Format URL with parameters
-        url = API_SERVICE["url"].format(
-            prompt=requests.utils.quote(prompt),
-            width=settings.get('width', 512),
-            height=settings.get('height', 512),
-            seed=seed,
-            model=model_param
-        )
+        async with get_http_client().stream("GET", spec.url()) as response:
+            if response.status_code != 200:
+                result = "http_error"
+                raise UpstreamStatusError(response.status_code, parse_retry_after(response.headers.get("retry-after")))
+            
+            try:
+                image_bytes = await read_image_body(response)
+            except UpstreamInvalidImage:
+                result = "invalid"
+                raise
         
-        # Add style modifiers for better quality
-        enhanced_prompt = f"{prompt}, detailed, high quality, 8k"
-        url = url.replace(requests.utils.quote(prompt), requests.utils.quote(enhanced_prompt))
+        result = "success"
+        recent_upstream_latencies.append(time.perf_counter() - start)
+        return image_bytes
+    
+    except httpx.TimeoutException as e:
+        result = "timeout"
+        raise UpstreamTimeout(f"Pollinations request timed out: {e}") from e
+    
+    except httpx.HTTPError as e:
+        raise UpstreamError(f"Error with Pollinations: {e}") from e
+    
+    except asyncio.CancelledError:
+        result = "cancelled"
+        raise
+    
+    finally:
+        GENERATIONS_IN_FLIGHT.dec()
+        GENERATIONS_TOTAL.inc(result=result)
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, model=spec.model_param, size=f"{spec.width}x{spec.height}")
+
+async def hedged_request(spec: PromptSpec) -> bytes:
+    """Race a second request with a different seed if the first one is slow."""
+    tasks = {asyncio.ensure_future(request_pollinations(spec))}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay())
+        if not done:
+            UPSTREAM_HEDGES_TOTAL.inc()
+            tasks.add(asyncio.ensure_future(
+                request_pollinations(spec.replace(seed=random.randint(1, 1000000)))
+            ))
         
-        response = requests.get(url, timeout=60)
+        error = None
+        pending = tasks
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def generate_image_pollinations(spec: PromptSpec, hedge: bool = False) -> bytes:
+    """Generate image using Pollinations AI.
+    
+    Retries retryable failures with jittered backoff (honouring Retry-After),
+    optionally hedges slow requests, and fails fast while the circuit is open.
+    """
+    if not upstream_breaker.allow():
+        GENERATIONS_TOTAL.inc(result="circuit_open")
+        raise CircuitOpenError("Pollinations circuit is open")
+    
+    if spec.seed is None:
+        spec = spec.replace(seed=random.randint(1, 1000000))
+    hedge = hedge and RESILIENCE_CONFIG["hedge"]
+    attempt = 0
+    
+    while True:
+        attempt += 1
+        try:
+            if hedge:
+                image_bytes = await hedged_request(spec)
+            else:
+                image_bytes = await request_pollinations(spec)
+            upstream_breaker.record_success()
+            return image_bytes
         
-        if response.status_code == 200:
-            return response.content
-        else:
-            logger.error(f"Pollinations API error: {response.status_code}")
-            return None
+        except UpstreamError as e:
+            if e.counts_as_failure:
+                upstream_breaker.record_failure()
+            if not e.retryable or attempt >= RESILIENCE_CONFIG["max_attempts"] or not upstream_breaker.allow():
+                logger.error(f"{e} (attempt {attempt})")
+                raise
             
-    except Exception as e:
-        logger.error(f"Error with Pollinations: {str(e)}")
-        return None
+            delay = backoff_delay(attempt, e.retry_after)
+            UPSTREAM_RETRIES_TOTAL.inc()
+            logger.warning(f"{e}, retrying in {delay:.1f}s (attempt {attempt})")
+            await asyncio.sleep(delay)
 
-async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str) -> None:
-    """Generate an image based on the given prompt."""
-    # Get user's clickable mention
-    user_mention = get_clickable_user_mention(update.effective_user)
+async def fetch_image(spec: PromptSpec, user_id: int, chat_id: int, priority: str = "generate",
+                      token=None) -> tuple:
+    """Return (cache key, file_id, image bytes) for a request, generating on a miss.
+    
+    The key is None when the result cannot be reused. When a Telegram
+    file_id is already known for the key the bytes are not loaded at all.
+    Identical concurrent requests share a single lookup and generation.
+    token is the job's scheduler token, see GenerationScheduler.slot.
+    """
+    return await image_flights.do(spec.key, load_or_generate_image, spec, user_id, chat_id, priority, token)
+
+async def load_or_generate_image(spec: PromptSpec, user_id: int, chat_id: int, priority: str,
+                                 token=None) -> tuple:
+    """Look a request up in the caches and generate it upstream on a miss."""
+    random_seed = spec.seed is None
+    
+    if random_seed:
+        # Random seed: reuse a recent result when the policy allows it, else a prewarmed one
+        key = image_cache.recent_key(spec.key) or prewarm_pool.take(spec.key)
+    else:
+        key = spec.key
+    
+    if key:
+        file_id = file_id_cache.get(key)
+        if file_id:
+            return key, file_id, None
+        image_bytes = await image_cache.get(key)
+        if image_bytes:
+            return key, None, image_bytes
+    
+    seeded = spec.replace(seed=random.randint(1, 1000000)) if random_seed else spec
+    
+    async with generation_scheduler.slot(user_id, chat_id, priority, token):
+        image_bytes = await generate_image_pollinations(seeded, hedge=random_seed)
+    
+    # Re-encode before caching so hits skip the work too
+    image_bytes = await postprocess_image(image_bytes)
+    
+    # Random-seed results are only worth keeping when they may be reused
+    if not image_bytes or (random_seed and image_cache.reuse_recent <= 0):
+        return None, None, image_bytes
+    
+    key = seeded.key
+    await image_cache.put(key, image_bytes)
+    if random_seed:
+        image_cache.remember_recent(spec.key, key)
     
-    user_settings = context.user_data.get('settings', DEFAULT_PARAMS.copy())
-    current_model = context.user_data.get('model', 'flux')
+    return key, None, image_bytes
+
+async def timed_upload(call):
+    """Run a Bot API upload, timing only the call itself and not its wait in outbound."""
+    start = time.perf_counter()
+    result = await call()
+    UPLOAD_SECONDS.observe(time.perf_counter() - start)
+    return result
+
+async def send_generated_photo(bot, chat_id: int, message_id: int, key: Optional[str],
+                               file_id: Optional[str], image_bytes: Optional[bytes], caption: str) -> None:
+    """Turn the status message into the photo, reusing a known file_id when possible."""
+    if file_id:
+        try:
+            await outbound.send(chat_id, functools.partial(
+                bot.edit_message_media,
+                chat_id=chat_id,
+                message_id=message_id,
+                media=InputMediaPhoto(media=file_id, caption=caption, parse_mode=ParseMode.HTML)
+            ), key=(chat_id, message_id))
+            return
+        except BadRequest as e:
+            if not is_file_id_error(e):
+                raise
+            # Stale or foreign file_id, fall back to uploading the bytes
+            logger.warning(f"Cached file_id rejected, re-uploading: {e}")
+            file_id_cache.discard(key)
+            image_bytes = await image_cache.get(key)
+            if not image_bytes:
+                raise StaleFileId() from e
+    
+    message = await outbound.send(chat_id, functools.partial(timed_upload, functools.partial(
+        bot.edit_message_media,
+        chat_id=chat_id,
+        message_id=message_id,
+        media=InputMediaPhoto(media=BytesIO(image_bytes), caption=caption, parse_mode=ParseMode.HTML)
+    )), key=(chat_id, message_id))
     
-    # Update settings with current model
-    user_settings['model'] = current_model
+    if key and isinstance(message, Message) and message.photo:
+        file_id_cache.set(key, message.photo[-1].file_id)
+
+async def send_generated_album(bot, chat_id: int, items: list) -> None:
+    """Send (key, file_id, image_bytes, caption) items as a single media group."""
+    def build_media(items: list) -> list:
+        return [
+            InputMediaPhoto(media=file_id or BytesIO(image_bytes), caption=caption, parse_mode=ParseMode.HTML)
+            for _, file_id, image_bytes, caption in items
+        ]
+    
+    try:
+        messages = await outbound.send(chat_id, functools.partial(timed_upload, functools.partial(
+            bot.send_media_group, chat_id=chat_id, media=build_media(items)
+        )))
+    except BadRequest as e:
+        if not any(file_id for _, file_id, _, _ in items) or not is_file_id_error(e):
+            raise
+        # One stale file_id fails the whole album, upload every photo instead
+        logger.warning(f"Cached file_id rejected in album, re-uploading: {e}")
+        reloaded = []
+        for key, file_id, image_bytes, caption in items:
+            if file_id:
+                file_id_cache.discard(key)
+                image_bytes = await image_cache.get(key)
+                if not image_bytes:
+                    continue
+            reloaded.append((key, None, image_bytes, caption))
+        if len(reloaded) < 2:
+            raise
+        items = reloaded
+        messages = await outbound.send(chat_id, functools.partial(timed_upload, functools.partial(
+            bot.send_media_group, chat_id=chat_id, media=build_media(items)
+        )))
     
-    # Apply style suffix if available
-    style_suffix = context.user_data.get('style_suffix', '')
-    if style_suffix:
-        prompt = f"{prompt}, {style_suffix}"
+    for (key, file_id, _, _), message in zip(items, messages):
+        if key and not file_id and message.photo:
+            file_id_cache.set(key, message.photo[-1].file_id)
+
+async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str,
+                         variants: int = 1, priority: str = "generate") -> None:
+    """Generate an image, or an album of variants, based on the given prompt."""
+    created_at = time.time()
     
     # Determine which message object to use
     if update.callback_query:
@@ -732,262 +3570,499 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, pro
     # Send random status emoji or message
     status_text = random.choice(STATUS_MESSAGES["generating"])
     if chat_id:
-        status_message = await send_method(
+        send_status = functools.partial(send_method, chat_id=chat_id, text=status_text)
+    else:
+        send_status = functools.partial(send_method, status_text)
+    status_message = await outbound.send(update.effective_chat.id, send_status, OutboundSender.STATUS)
+    
+    await dispatch_generation(context.bot, make_generation_job(
+        update, status_message, prompt, "image_generated", created_at, variants, priority
+    ))
+
+def make_generation_job(update: Update, status_message: Message, prompt: str,
+                        caption_key: str, created_at: float, variants: int = 1,
+                        priority: str = "generate") -> dict:
+    """Capture everything a worker needs to finish a generation without the update."""
+    return {
+        "chat_id": update.effective_chat.id,
+        "status_message_id": status_message.message_id,
+        "user_id": update.effective_user.id,
+        "mention": get_clickable_user_mention(update.effective_user),
+        "prompt": prompt,
+        "caption_key": caption_key,
+        "created_at": created_at,
+        "variants": variants,
+        "priority": priority
+    }
+
+async def dispatch_generation(bot, job: dict) -> None:
+    """Run a generation job here, or hand it to the worker pool in ingress mode."""
+    if PROCESS_ROLE == "ingress":
+        # Workers read settings from shared storage, make sure they see recent changes
+        await settings_store.flush()
+        try:
+            await generation_queue.put(job)
+        except SchedulerBusy:
+            logger.warning(f"Generation queue full, rejecting request in chat {job['chat_id']}")
+            await edit_job_status(bot, job, ERROR_MESSAGES["busy"].format(user_name=job["mention"]))
+    else:
+        await inflight_jobs.run(bot, job)
+
+# Progress edits of a job's status message while it waits and generates
+PROGRESS_CONFIG = {
+    "enabled": os.getenv("PROGRESS_UPDATES", "1") != "0",
+    # Results faster than this never see a progress edit
+    "first_delay": float(os.getenv("PROGRESS_FIRST_DELAY", "4")),
+    # Each later edit waits this much longer than the previous one, up to max_interval
+    "growth": 1.5,
+    "max_interval": float(os.getenv("PROGRESS_MAX_INTERVAL", "15")),
+    # How often queue position and phase are checked between edits, no API calls involved
+    "poll": 0.5,
+    # Skip an edit when the median upstream latency says the photo is this close
+    "imminent": 2.0,
+    # Outbound requests waiting for budget above which progress edits are dropped
+    "max_backlog": int(os.getenv("PROGRESS_MAX_BACKLOG", "50"))
+}
+
+class GenerationProgress:
+    """Edit a job's status message with elapsed time and queue position.
+    
+    Edits start after first_delay and then back off, go through outbound as
+    keyed status requests so a newer edit or the result supersedes a stale
+    one, and are skipped when the photo is imminent or outbound is backed
+    up. stop() must be awaited before the final edit. token is the job's
+    scheduler token, its generations must be fetched with it.
+    """
+    
+    def __init__(self, bot, job: dict, first_delay: float, growth: float, max_interval: float,
+                 poll: float, imminent: float, max_backlog: int, enabled: bool = True):
+        self.bot = bot
+        self.job = job
+        self.first_delay = first_delay
+        self.growth = growth
+        self.max_interval = max_interval
+        self.poll = poll
+        self.imminent = imminent
+        self.max_backlog = max_backlog
+        self.enabled = enabled
+        self.token = object()
+        self._task = None
+        self._running_since = None
+    
+    @classmethod
+    def for_job(cls, bot, job: dict) -> "GenerationProgress":
+        return cls(bot, job, **PROGRESS_CONFIG)
+    
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop editing; an edit already sent finishes before any later edit with the same key."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def _position(self) -> Optional[int]:
+        position = generation_scheduler.position(self.token)
+        if position is None and self._running_since is None:
+            self._running_since = time.monotonic()
+        return position
+    
+    def _imminent(self) -> bool:
+        if self._running_since is None or len(recent_upstream_latencies) < 5:
+            return False
+        expected = sorted(recent_upstream_latencies)[len(recent_upstream_latencies) // 2]
+        return 0 < expected - (time.monotonic() - self._running_since) <= self.imminent
+    
+    async def _run(self) -> None:
+        chat_id = self.job["chat_id"]
+        message_id = self.job["status_message_id"]
+        interval = self.first_delay
+        next_edit = time.monotonic() + interval
+        while True:
+            await asyncio.sleep(min(self.poll, max(0.0, next_edit - time.monotonic())))
+            position = self._position()
+            if time.monotonic() < next_edit:
+                continue
+            interval = min(interval * self.growth, self.max_interval)
+            next_edit = time.monotonic() + interval
+            
+            if self._imminent():
+                PROGRESS_EDITS_TOTAL.inc(result="imminent")
+                continue
+            if outbound.backlog() > self.max_backlog:
+                PROGRESS_EDITS_TOTAL.inc(result="backlog")
+                continue
+            
+            fields = {
+                "status": random.choice(STATUS_MESSAGES["processing"]),
+                "elapsed": int(time.time() - self.job["created_at"])
+            }
+            if position is None:
+                text = STATUS_MESSAGES["progress_running"].format(**fields)
+            else:
+                text = STATUS_MESSAGES["progress_queued"].format(position=position + 1, **fields)
+            try:
+                result = await outbound.send(chat_id, functools.partial(
+                    self.bot.edit_message_text, text, chat_id=chat_id, message_id=message_id
+                ), OutboundSender.STATUS, key=(chat_id, message_id))
+            except BadRequest as e:
+                # Gone or no longer text, nothing left to update
+                logger.debug(f"Stopping progress edits in chat {chat_id}: {e}")
+                PROGRESS_EDITS_TOTAL.inc(result="failed")
+                return
+            except Exception as e:
+                logger.debug(f"Progress edit failed in chat {chat_id}: {e}")
+                PROGRESS_EDITS_TOTAL.inc(result="failed")
+                continue
+            PROGRESS_EDITS_TOTAL.inc(result="sent" if result is not None else "superseded")
+
+async def edit_job_status(bot, job: dict, text: str) -> None:
+    """Replace a job's status message with text, sending a new message if that fails."""
+    chat_id = job["chat_id"]
+    try:
+        await outbound.send(chat_id, functools.partial(
+            bot.edit_message_text,
+            text,
             chat_id=chat_id,
-            text=status_text
-        )
+            message_id=job["status_message_id"],
+            parse_mode=ParseMode.HTML
+        ), key=(chat_id, job["status_message_id"]))
+    except Exception:
+        await outbound.send(chat_id, functools.partial(
+            bot.send_message, chat_id=chat_id, text=text, parse_mode=ParseMode.HTML
+        ))
+
+def generation_error_message(error: Optional[BaseException], user_mention: str) -> str:
+    """Pick the user-facing message for a failed generation."""
+    if isinstance(error, SchedulerBusy):
+        key = "busy"
+    elif isinstance(error, CircuitOpenError):
+        key = "network_error"
+    elif isinstance(error, UpstreamTimeout):
+        key = "timeout_error"
     else:
-        status_message = await send_method(status_text)
+        key = "generation_failed"
+    return ERROR_MESSAGES[key].format(user_name=user_mention)
+
+async def run_generation_job(bot, job: dict) -> None:
+    """Generate the image for a job and turn its status message into the photo."""
+    if job.get("variants", 1) > 1:
+        await run_variants_job(bot, job)
+        return
+    
+    chat_id = job["chat_id"]
+    user_mention = job["mention"]
     
     try:
-        image_bytes = await generate_image_pollinations(prompt, user_settings)
+        settings = await settings_store.get(job["user_id"])
+        spec = PromptSpec.from_settings(job["prompt"], settings)
+        if job.get("priority") != "sample":
+            prewarm_pool.record_prompt(spec)
         
-        if image_bytes:
-            # Edit the status message with the generated image
-            image_stream = BytesIO(image_bytes)
-            
-            # Get clean prompt (remove style suffix for display)
-            clean_prompt = prompt
-            if context.user_data.get('style_suffix'):
-                clean_prompt = prompt.replace(', ' + context.user_data.get('style_suffix'), '')
-            
-            # Escape the prompt for HTML
-            escaped_prompt = html.escape(clean_prompt)
-            
-            caption = SUCCESS_MESSAGES["image_generated"].format(
-                user_name=user_mention, 
-                prompt=escaped_prompt
+        progress = GenerationProgress.for_job(bot, job)
+        progress.start()
+        try:
+            key, file_id, image_bytes = await fetch_image(
+                spec, job["user_id"], chat_id, job.get("priority", "generate"), progress.token
             )
+        finally:
+            await progress.stop()
+        
+        if file_id or image_bytes:
+            caption = spec.caption(SUCCESS_MESSAGES[job["caption_key"]], user_mention)
             
-            await context.bot.edit_message_media(
-                chat_id=update.effective_chat.id,
-                message_id=status_message.message_id,
-                media=InputMediaPhoto(
-                    media=image_stream,
-                    caption=caption,
-                    parse_mode=ParseMode.HTML
+            # Edit the status message with the generated image
+            try:
+                await send_generated_photo(
+                    bot,
+                    chat_id,
+                    job["status_message_id"],
+                    key,
+                    file_id,
+                    image_bytes,
+                    caption
                 )
-            )
+            except StaleFileId:
+                # Neither cache holds the image any more, generate it afresh
+                key, file_id, image_bytes = await fetch_image(
+                    spec, job["user_id"], chat_id, job.get("priority", "generate")
+                )
+                if not (file_id or image_bytes):
+                    raise
+                await send_generated_photo(bot, chat_id, job["status_message_id"], key, file_id, image_bytes, caption)
+            GENERATION_SECONDS.observe(time.time() - job["created_at"], priority=job.get("priority", "generate"))
             
         else:
             # Generation failed - edit the status message with error
-            await status_message.edit_text(
-                ERROR_MESSAGES["generation_failed"].format(user_name=user_mention), 
-                parse_mode=ParseMode.HTML
-            )
+            await edit_job_status(bot, job, ERROR_MESSAGES["generation_failed"].format(user_name=user_mention))
+            
+    except SchedulerBusy:
+        logger.warning(f"Generation queue full, rejecting request in chat {chat_id}")
+        await edit_job_status(bot, job, ERROR_MESSAGES["busy"].format(user_name=user_mention))
+    
+    except CircuitOpenError:
+        await edit_job_status(bot, job, ERROR_MESSAGES["network_error"].format(user_name=user_mention))
+    
+    except UpstreamTimeout:
+        await edit_job_status(bot, job, ERROR_MESSAGES["timeout_error"].format(user_name=user_mention))
             
     except Exception as e:
         logger.error(f"Error generating image: {str(e)}")
         try:
-            await status_message.edit_text(
-                ERROR_MESSAGES["generation_failed"].format(user_name=user_mention),
-                parse_mode=ParseMode.HTML
-            )
+            await edit_job_status(bot, job, ERROR_MESSAGES["generation_failed"].format(user_name=user_mention))
         except Exception:
             pass
 
-async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle callback queries from inline keyboards."""
-    query = update.callback_query
-    await query.answer()
+async def run_variants_job(bot, job: dict) -> None:
+    """Generate several seeds of one prompt concurrently and send them as one album."""
+    chat_id = job["chat_id"]
+    user_mention = job["mention"]
     
-    # Get user's clickable mention
-    user_mention = get_clickable_user_mention(update.effective_user)
+    try:
+        settings = await settings_store.get(job["user_id"])
+        spec = PromptSpec.from_settings(job["prompt"], settings)
+        
+        # Explicit seeds keep the variants apart in the cache and in coalescing.
+        # One token makes them a single job for the user and chat caps, the
+        # global limit still bounds how many of them hit upstream at once
+        seeds = random.sample(range(1, 1_000_000), job["variants"])
+        progress = GenerationProgress.for_job(bot, job)
+        progress.start()
+        try:
+            results = await asyncio.gather(*(
+                fetch_image(spec.replace(seed=seed), job["user_id"], chat_id, job.get("priority", "generate"),
+                            progress.token)
+                for seed in seeds
+            ), return_exceptions=True)
+        finally:
+            await progress.stop()
+        
+        images = [result for result in results
+                  if not isinstance(result, BaseException) and (result[1] or result[2])]
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if not images:
+            await edit_job_status(bot, job, generation_error_message(errors[0] if errors else None, user_mention))
+            return
+        if len(images) < len(seeds):
+            logger.warning(f"{len(seeds) - len(images)} of {len(seeds)} variants failed in chat {chat_id}")
+        
+        items = [
+            (key, file_id, image_bytes, spec.caption(SUCCESS_MESSAGES["image_variant"], user_mention, index=index))
+            for index, (key, file_id, image_bytes) in enumerate(images, 1)
+        ]
+        
+        if len(items) == 1:
+            # An album needs at least two photos, a single survivor replaces the status
+            key, file_id, image_bytes, caption = items[0]
+            await send_generated_photo(bot, chat_id, job["status_message_id"], key, file_id, image_bytes, caption)
+        else:
+            await send_generated_album(bot, chat_id, items)
+            try:
+                await outbound.send(chat_id, functools.partial(
+                    bot.delete_message, chat_id=chat_id, message_id=job["status_message_id"]
+                ), OutboundSender.STATUS, key=(chat_id, job["status_message_id"]))
+            except Exception:
+                pass
+        GENERATION_SECONDS.observe(time.time() - job["created_at"], priority=job.get("priority", "generate"))
     
+    except Exception as e:
+        logger.error(f"Error generating variants: {str(e)}")
+        try:
+            await edit_job_status(bot, job, generation_error_message(e, user_mention))
+        except Exception:
+            pass
+
+async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Route callback queries from inline keyboards through the callback tables."""
+    query = update.callback_query
     data = query.data
-    user_settings = context.user_data.get('settings', DEFAULT_PARAMS.copy())
+    user_id = update.effective_user.id
+    CALLBACK_QUERIES_TOTAL.inc(route=callback_route_name(data))
     
-    if data == "sample":
-        sample_prompt = random.choice(RANDOM_PROMPTS)
-        await generate_image(update, context, sample_prompt)
-    
-    elif data == "select_model":
-        await model_selection_menu(update, context)
-    
-    elif data == "settings_menu":
-        await settings_menu_callback(update, context)
-    
-    elif data == "help_menu":
-        await help_menu_callback(update, context)
-    
-    elif data == "style_presets":
-        await style_presets_menu(update, context)
+    # Generating buttons are rate limited, the refusal is a toast only the tapper sees
+    cost = GENERATION_CALLBACKS.get(data)
+    if cost:
+        decision = rate_limiter.check("callback", user_id, update.effective_chat.id, cost)
+        if decision != RateLimiter.ALLOW:
+            await query.answer(RATE_LIMITED_TOAST if decision == RateLimiter.WARN else None)
+            return
+    await query.answer()
     
-    elif data == "random_prompt":
-        random_prompt = random.choice(RANDOM_PROMPTS)
-        await generate_image(update, context, random_prompt)
+    route = resolve_callback(data)
+    if route is None:
+        return
+    handler, args = route
+    with loop_monitor.handler(handler.__name__):
+        await handler(update, context, *args)
+
+def resolve_callback(data: str) -> Optional[tuple]:
+    """Return (handler, parsed args) for callback data, or None if it is unknown or invalid."""
+    handler = CALLBACK_ROUTES.get(data)
+    if handler:
+        return handler, ()
     
-    elif data == "size_options":
-        await size_options_menu(update, context)
+    head, sep, value = data.partition("_")
+    route = CALLBACK_PREFIX_ROUTES.get(head + sep)
+    if route is None:
+        return None
+    parse, handler = route
+    try:
+        return handler, (parse(value),)
+    except ValueError:
+        return None
+
+def callback_route_name(data: str) -> str:
+    """Return the routing table entry callback data falls under, a bounded metric label."""
+    if data in CALLBACK_ROUTES:
+        return data
+    head, sep, _ = data.partition("_")
+    return head + sep if head + sep in CALLBACK_PREFIX_ROUTES else "unknown"
+
+def parse_model_data(value: str) -> str:
+    """Parse the model key from model_<key>."""
+    if value not in MODEL_CODES:
+        raise ValueError(f"Unknown model {value!r}")
+    return value
+
+def parse_size_data(value: str) -> tuple:
+    """Parse (width, height) from size_<side> or size_<width>_<height>."""
+    sides = tuple(int(side) for side in value.split("_"))
+    size = sides * 2 if len(sides) == 1 else sides
+    if size not in SIZE_CODES:
+        raise ValueError(f"Unsupported size {value!r}")
+    return size
+
+def parse_style_data(value: str) -> str:
+    """Parse the preset name from style_<preset>."""
+    if value not in STYLE_PRESETS:
+        raise ValueError(f"Unknown style {value!r}")
+    return value
+
+async def sample_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Generate an image for a random sample prompt, preferring prewarmed ones."""
+    settings = await settings_store.get(update.effective_user.id)
+    sample_prompt = prewarm_pool.pick_sample(settings)
+    await generate_image(update, context, sample_prompt, priority="sample")
+
+async def sample_album_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Generate an album of variants for a random sample prompt."""
+    sample_prompt = random.choice(RANDOM_PROMPTS)
+    await generate_image(update, context, sample_prompt, VARIANT_CONFIG["sample_album"], "sample")
+
+async def model_chosen_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, model: str) -> None:
+    """Save the selected model and confirm it."""
+    user_id = update.effective_user.id
+    settings = await settings_store.get(user_id)
+    settings_store.set(user_id, settings.replace(model=model))
     
-    elif data.startswith("model_"):
-        # Handle model selection: model_modelname
-        model = data.split("_", 1)[1]
-        context.user_data['model'] = model
-        
-        # Get model info for display
-        model_info = API_SERVICE["models"].get(model, {})
-        model_name = model_info.get("name", model.upper())
-        
-        success_text = SUCCESS_MESSAGES["model_selected"].format(
-            user_name=user_mention,
-            service=API_SERVICE['name'],
-            model=model_name,
-            description=model_info.get('description', 'No description available')
-        )
-        
-        await query.edit_message_text(
-            success_text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
-                    InlineKeyboardButton("🤖 Change Model", callback_data="select_model")
-                ],
-                [InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")]
-            ])
-        )
+    # Get model info for display
+    model_info = API_SERVICE["models"].get(model, {})
+    model_name = model_info.get("name", model.upper())
     
-    elif data.startswith("size_"):
-        size_parts = data.split("_")
-        if len(size_parts) == 3:
-            width = int(size_parts[1])
-            height = int(size_parts[2])
-        else:
-            size = int(size_parts[1])
-            width = height = size
-            
-        user_settings['width'] = width
-        user_settings['height'] = height
-        context.user_data['settings'] = user_settings
-        
-        success_text = SUCCESS_MESSAGES["size_updated"].format(
-            user_name=user_mention,
-            width=width,
-            height=height
-        )
-        
-        await query.edit_message_text(
-            success_text,
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
-                    InlineKeyboardButton("📊 More Sizes", callback_data="size_options")
-                ],
-                [InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")]
-            ])
-        )
+    success_text = SUCCESS_MESSAGES["model_selected"].format(
+        user_name=get_clickable_user_mention(update.effective_user),
+        service=API_SERVICE['name'],
+        model=model_name,
+        description=model_info.get('description', 'No description available')
+    )
     
-    elif data.startswith("style_"):
-        style = data.split("_", 1)[1]
-        
-        if style in STYLE_PRESETS:
-            context.user_data['style_suffix'] = STYLE_PRESETS[style]
-            
-            success_text = SUCCESS_MESSAGES["style_applied"].format(
-                user_name=user_mention,
-                style=style.replace('_', ' ').title(),
-                modifier=STYLE_PRESETS[style]
-            )
-            
-            await query.edit_message_text(
-                success_text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
-                        InlineKeyboardButton("🌟 Change Style", callback_data="style_presets")
-                    ],
-                    [InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")]
-                ])
-            )
+    await update.callback_query.edit_message_text(
+        success_text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=KEYBOARDS["model_selected"]
+    )
+
+async def size_chosen_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, size: tuple) -> None:
+    """Save the selected image size and confirm it."""
+    user_id = update.effective_user.id
+    settings = await settings_store.get(user_id)
+    settings_store.set(user_id, settings.replace(size=size))
     
-    elif data == "reset_settings":
-        context.user_data['settings'] = DEFAULT_PARAMS.copy()
-        context.user_data['model'] = 'flux'
-        context.user_data.pop('style_suffix', None)
-        
-        await query.edit_message_text(
-            SUCCESS_MESSAGES["settings_reset"].format(user_name=user_mention),
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("🎨 Generate Sample", callback_data="sample"),
-                    InlineKeyboardButton("⚙️ Settings", callback_data="settings_menu")
-                ],
-                [InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")]
-            ])
-        )
+    success_text = SUCCESS_MESSAGES["size_updated"].format(
+        user_name=get_clickable_user_mention(update.effective_user),
+        width=size[0],
+        height=size[1]
+    )
     
-    elif data == "back_to_generate":
-        # Return to generate menu
-        keyboard = [
-            [
-                InlineKeyboardButton("🤖 Select Model", callback_data="select_model"),
-                InlineKeyboardButton("🎨 Generate Sample", callback_data="sample")
-            ],
-            [
-                InlineKeyboardButton("⚙️ Settings", callback_data="settings_menu"),
-                InlineKeyboardButton("❓ Help", callback_data="help_menu")
-            ],
-            [
-                InlineKeyboardButton("🌟 Style Presets", callback_data="style_presets"),
-                InlineKeyboardButton("🎲 Random Prompt", callback_data="random_prompt")
-            ],
-            [
-                InlineKeyboardButton("📊 Image Sizes", callback_data="size_options"),
-                InlineKeyboardButton("🔄 Reset Settings", callback_data="reset_settings")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            MENU_MESSAGES["generate_menu"].format(user_name=user_mention),
-            parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
-        )
+    await update.callback_query.edit_message_text(
+        success_text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=KEYBOARDS["size_updated"]
+    )
+
+async def style_chosen_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, style: str) -> None:
+    """Save the selected style preset and confirm it."""
+    user_id = update.effective_user.id
+    settings = await settings_store.get(user_id)
+    settings_store.set(user_id, settings.replace(style=style))
     
-    elif data == "expand_guide":
-        keyboard = [
-            [
-                InlineKeyboardButton("📚 Minimize Guide", callback_data="minimize_guide")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            HELP_MESSAGES["expanded"].format(user_name=user_mention),
-            parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
-        )
+    success_text = SUCCESS_MESSAGES["style_applied"].format(
+        user_name=get_clickable_user_mention(update.effective_user),
+        style=style.replace('_', ' ').title(),
+        modifier=STYLE_PRESETS[style]
+    )
     
-    elif data == "minimize_guide":
-        keyboard = [
-            [
-                InlineKeyboardButton("📖 Expand Guide", callback_data="expand_guide")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            HELP_MESSAGES["basic"].format(user_name=user_mention),
-            parse_mode=ParseMode.HTML,
-            reply_markup=reply_markup
-        )
+    await update.callback_query.edit_message_text(
+        success_text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=KEYBOARDS["style_applied"]
+    )
+
+async def reset_settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Restore the default model, size and style."""
+    settings_store.set(update.effective_user.id, UserSettings())
     
-    elif data == "delete_message":
-        try:
-            await query.message.delete()
-        except Exception:
-            await query.answer("Cannot delete this message.", show_alert=True)
+    await update.callback_query.edit_message_text(
+        SUCCESS_MESSAGES["settings_reset"].format(user_name=get_clickable_user_mention(update.effective_user)),
+        parse_mode=ParseMode.HTML,
+        reply_markup=KEYBOARDS["settings_reset"]
+    )
+
+async def back_to_generate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Return to the generate menu."""
+    await update.callback_query.edit_message_text(
+        MENU_MESSAGES["generate_menu"].format(user_name=get_clickable_user_mention(update.effective_user)),
+        parse_mode=ParseMode.HTML,
+        reply_markup=KEYBOARDS["generate_menu"]
+    )
+
+async def expand_guide_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the full help guide."""
+    await update.callback_query.edit_message_text(
+        HELP_MESSAGES["expanded"].format(user_name=get_clickable_user_mention(update.effective_user)),
+        parse_mode=ParseMode.HTML,
+        reply_markup=KEYBOARDS["minimize_guide"]
+    )
+
+async def minimize_guide_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Collapse the help guide back to the basics."""
+    await update.callback_query.edit_message_text(
+        HELP_MESSAGES["basic"].format(user_name=get_clickable_user_mention(update.effective_user)),
+        parse_mode=ParseMode.HTML,
+        reply_markup=KEYBOARDS["expand_guide"]
+    )
+
+async def delete_message_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Delete the message the button is attached to."""
+    query = update.callback_query
+    try:
+        await query.message.delete()
+    except Exception:
+        await query.answer("Cannot delete this message.", show_alert=True)
 
 async def model_selection_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show AI model selection menu."""
     # Get user's clickable mention
     user_mention = get_clickable_user_mention(update.effective_user)
     
-    current_model = context.user_data.get('model', 'flux')
+    settings = await settings_store.get(update.effective_user.id)
+    current_model = settings.model
     
     model_text = MENU_MESSAGES["model_selection"].format(
         user_name=user_mention,
@@ -995,19 +4070,7 @@ async def model_selection_menu(update: Update, context: ContextTypes.DEFAULT_TYP
         model=current_model.upper()
     )
     
-    keyboard = []
-    
-    # Pollinations models
-    for model_key, model_info in API_SERVICE["models"].items():
-        status = "✅" if current_model == model_key else ""
-        keyboard.append([InlineKeyboardButton(
-            f"{status} {model_info['name']}", 
-            callback_data=f"model_{model_key}"
-        )])
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = model_selection_keyboard(current_model)
     
     if update.callback_query:
         await update.callback_query.edit_message_text(
@@ -1027,38 +4090,21 @@ async def settings_menu_callback(update: Update, context: ContextTypes.DEFAULT_T
     # Get user's clickable mention
     user_mention = get_clickable_user_mention(update.effective_user)
     
-    user_settings = context.user_data.get('settings', DEFAULT_PARAMS.copy())
-    current_model = context.user_data.get('model', 'flux')
+    settings = await settings_store.get(update.effective_user.id)
+    current_model = settings.model
     
     settings_text = MENU_MESSAGES["settings_menu"].format(
         user_name=user_mention,
         service=API_SERVICE['name'],
         model=current_model.upper(),
-        width=user_settings['width'],
-        height=user_settings['height']
+        width=settings.width,
+        height=settings.height
     )
     
-    keyboard = [
-        [
-            InlineKeyboardButton("512x512", callback_data="size_512"),
-            InlineKeyboardButton("768x768", callback_data="size_768"),
-            InlineKeyboardButton("1024x1024", callback_data="size_1024")
-        ],
-        [
-            InlineKeyboardButton("Portrait 512x768", callback_data="size_512_768"),
-            InlineKeyboardButton("Landscape 768x512", callback_data="size_768_512")
-        ],
-        [
-            InlineKeyboardButton("🔄 Reset", callback_data="reset_settings"),
-            InlineKeyboardButton("⬅️ Back", callback_data="back_to_generate")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.callback_query.edit_message_text(
         settings_text,
         parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
+        reply_markup=KEYBOARDS["settings_menu"]
     )
 
 async def help_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1066,19 +4112,10 @@ async def help_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Get user's clickable mention
     user_mention = get_clickable_user_mention(update.effective_user)
     
-    keyboard = [
-        [
-            InlineKeyboardButton("🎨 Try Sample", callback_data="sample"),
-            InlineKeyboardButton("🤖 Select Model", callback_data="select_model")
-        ],
-        [InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.callback_query.edit_message_text(
         MENU_MESSAGES["help_menu"].format(user_name=user_mention),
         parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
+        reply_markup=KEYBOARDS["help_menu"]
     )
 
 async def style_presets_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1086,45 +4123,18 @@ async def style_presets_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Get user's clickable mention
     user_mention = get_clickable_user_mention(update.effective_user)
     
-    current_style = context.user_data.get('style_suffix', 'None')
+    settings = await settings_store.get(update.effective_user.id)
+    current_style = settings.style_suffix or 'None'
     
     style_text = MENU_MESSAGES["style_presets"].format(
         user_name=user_mention,
         style=current_style
     )
     
-    keyboard = [
-        [
-            InlineKeyboardButton("🎌 Anime", callback_data="style_anime"),
-            InlineKeyboardButton("📸 Realistic", callback_data="style_realistic")
-        ],
-        [
-            InlineKeyboardButton("🧙 Fantasy", callback_data="style_fantasy"),
-            InlineKeyboardButton("🌆 Cyberpunk", callback_data="style_cyberpunk")
-        ],
-        [
-            InlineKeyboardButton("🎨 Cartoon", callback_data="style_cartoon"),
-            InlineKeyboardButton("🖼️ Oil Painting", callback_data="style_oil_painting")
-        ],
-        [
-            InlineKeyboardButton("🌊 Watercolor", callback_data="style_watercolor"),
-            InlineKeyboardButton("💻 Digital Art", callback_data="style_digital_art")
-        ],
-        [
-            InlineKeyboardButton("📼 Vintage", callback_data="style_vintage"),
-            InlineKeyboardButton("🔵 Minimalist", callback_data="style_minimalist")
-        ],
-        [
-            InlineKeyboardButton("🔄 Clear Style", callback_data="reset_settings"),
-            InlineKeyboardButton("⬅️ Back", callback_data="back_to_generate")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.callback_query.edit_message_text(
         style_text,
         parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
+        reply_markup=KEYBOARDS["style_presets"]
     )
 
 async def size_options_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1132,39 +4142,43 @@ async def size_options_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Get user's clickable mention
     user_mention = get_clickable_user_mention(update.effective_user)
     
-    user_settings = context.user_data.get('settings', DEFAULT_PARAMS.copy())
-    current_size = f"{user_settings['width']}x{user_settings['height']}"
+    settings = await settings_store.get(update.effective_user.id)
+    current_size = f"{settings.width}x{settings.height}"
     
     size_text = MENU_MESSAGES["size_options"].format(
         user_name=user_mention,
         size=current_size
     )
     
-    keyboard = [
-        [
-            InlineKeyboardButton("512x512 (Square)", callback_data="size_512"),
-            InlineKeyboardButton("768x768 (Square)", callback_data="size_768")
-        ],
-        [
-            InlineKeyboardButton("1024x1024 (Square)", callback_data="size_1024"),
-            InlineKeyboardButton("1024x768 (Wide)", callback_data="size_1024_768")
-        ],
-        [
-            InlineKeyboardButton("512x768 (Portrait)", callback_data="size_512_768"),
-            InlineKeyboardButton("768x512 (Landscape)", callback_data="size_768_512")
-        ],
-        [
-            InlineKeyboardButton("⬅️ Back to Generate", callback_data="back_to_generate")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.callback_query.edit_message_text(
         size_text,
         parse_mode=ParseMode.HTML,
-        reply_markup=reply_markup
+        reply_markup=KEYBOARDS["size_options"]
     )
 
+# Callback data routing: exact matches first, then the prefix up to the first "_"
+CALLBACK_ROUTES = {
+    "sample": sample_callback,
+    "random_prompt": sample_callback,
+    "sample_album": sample_album_callback,
+    "select_model": model_selection_menu,
+    "settings_menu": settings_menu_callback,
+    "help_menu": help_menu_callback,
+    "style_presets": style_presets_menu,
+    "size_options": size_options_menu,
+    "reset_settings": reset_settings_callback,
+    "back_to_generate": back_to_generate_callback,
+    "expand_guide": expand_guide_callback,
+    "minimize_guide": minimize_guide_callback,
+    "delete_message": delete_message_callback
+}
+
+CALLBACK_PREFIX_ROUTES = {
+    "model_": (parse_model_data, model_chosen_callback),
+    "size_": (parse_size_data, size_chosen_callback),
+    "style_": (parse_style_data, style_chosen_callback)
+}
+
 async def ping_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the /ping command with animation."""
     import time
@@ -1206,39 +4220,260 @@ async def setup_bot_commands(application: Application) -> None:
         (BOT_COMMANDS["help"]["command"], BOT_COMMANDS["help"]["description"]),
     ]
     
-    await application.bot.set_my_commands(commands)
+    try:
+        await application.bot.set_my_commands(commands)
+    except Exception as e:
+        logger.warning(f"Failed to register bot commands: {e}")
+        return
     logger.info("Bot commands menu registered successfully")
 
-def main():
-    """Main function to run the bot."""
-    logger.info(f"Starting bot with token: {BOT_TOKEN[:10]}...")
+def start_background_tasks(application: Application) -> None:
+    """Start boot work that must not hold up the first update."""
+    application.create_task(setup_bot_commands(application))
+    application.create_task(inflight_jobs.resume(application.bot))
+
+async def flush_file_id_cache(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodically persist newly learned file_ids."""
+    await file_id_cache.flush()
+
+async def flush_settings(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Write batched settings changes to storage."""
+    await settings_store.flush()
+
+async def prewarm_images(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Top up the prewarm pool in the background without holding up the job queue."""
+    if not prewarm_pool.running:
+        context.application.create_task(prewarm_pool.refill())
+
+async def on_shutdown(application: Application) -> None:
+    """Release shared resources when the application shuts down."""
+    await outbound.close()
+    shutdown_postprocess_executor()
+    await settings_store.flush()
+    settings_store.backend.close()
+    await file_id_cache.flush()
+    inflight_jobs.journal.close()
+    await close_http_client()
+
+def make_http_server(application: Optional[Application] = None) -> AsyncHTTPServer:
+    """Build the PORT server: liveness, readiness and metrics, plus webhook ingestion when given an application."""
+    port = int(os.environ.get("PORT", 5000))
+    server = AsyncHTTPServer("0.0.0.0", port, max_body=WEBHOOK_CONFIG["max_body"])
+    server.route("GET", "/", health_route)
+    server.route("GET", "/healthz", health_route)
+    server.route("GET", "/readyz", readiness_route)
+    server.route("GET", "/metrics", metrics_route)
+    if application is not None:
+        server.route("POST", WEBHOOK_CONFIG["path"], make_webhook_route(application, WEBHOOK_CONFIG["secret"]))
+    return server
+
+async def serve_webhook(application: Application, stop_event: Optional[asyncio.Event] = None) -> None:
+    """Run the bot in webhook mode, serving updates, health and metrics on PORT."""
+    server = make_http_server(application)
+    
+    if stop_event is None:
+        stop_event = make_stop_event()
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    loop_monitor.start()
+    await server.start()
+    await application.start()
+    start_background_tasks(application)
+    
+    webhook_url = WEBHOOK_CONFIG["url"].rstrip("/") + WEBHOOK_CONFIG["path"]
+    await application.bot.set_webhook(
+        url=webhook_url,
+        secret_token=WEBHOOK_CONFIG["secret"],
+        allowed_updates=Update.ALL_TYPES
+    )
+    logger.info(f"Receiving updates via webhook at {webhook_url}")
+    mark_boot("ready")
     
-    # Start dummy server in a separate thread
-    threading.Thread(target=start_dummy_server, daemon=True).start()
+    try:
+        await stop_event.wait()
+    finally:
+        # Leave the webhook registered so other replicas keep receiving updates,
+        # Telegram retries whatever this one refuses while draining. Health and
+        # metrics stay up until the drain is over
+        await stop_application(application)
+        await server.stop()
+        await loop_monitor.stop()
+
+async def serve_polling(application: Application, stop_event: Optional[asyncio.Event] = None) -> None:
+    """Run the bot with long polling until stopped, draining generations on the way out."""
+    server = make_http_server()
+    
+    if stop_event is None:
+        stop_event = make_stop_event()
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    loop_monitor.start()
+    await server.start()
+    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    await application.start()
+    start_background_tasks(application)
+    mark_boot("ready")
+    
+    try:
+        await stop_event.wait()
+    finally:
+        # Unfetched updates stay with Telegram for the next process; health stays
+        # up through the drain so readiness can report it
+        await application.updater.stop()
+        await stop_application(application)
+        await server.stop()
+        await loop_monitor.stop()
+
+async def stop_application(application: Application) -> None:
+    """Drain in-flight generations, then stop and shut the application down."""
+    await inflight_jobs.drain()
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+def make_stop_event() -> asyncio.Event:
+    """Return an event set by SIGINT or SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def run_worker(stop_event: Optional[asyncio.Event] = None) -> None:
+    """Consume generation jobs from the shared queue until stopped."""
+    concurrency = int(os.getenv("WORKER_CONCURRENCY", str(SCHEDULER_CONFIG["global_limit"])))
+    
+    # Settings change in other processes, always read them from shared storage
+    settings_store.cache_size = 0
+    
+    if stop_event is None:
+        stop_event = make_stop_event()
+    
+    bot_kwargs = {}
+    if BOT_API_URL:
+        bot_kwargs = {"base_url": f"{BOT_API_URL}/bot", "base_file_url": f"{BOT_API_URL}/file/bot"}
+    
+    async def consume(bot: Bot) -> None:
+        while not inflight_jobs.draining:
+            job = await generation_queue.get()
+            # Only acknowledge finished jobs, cut-off ones go straight back to the queue
+            try:
+                async with inflight_jobs.track():
+                    if job.get("shed"):
+                        # Pushed out of a full queue by higher-priority work
+                        await edit_job_status(bot, job, ERROR_MESSAGES["busy"].format(user_name=job["mention"]))
+                    else:
+                        with loop_monitor.handler("run_generation_job"):
+                            await run_generation_job(bot, job)
+            except asyncio.CancelledError:
+                await generation_queue.release(job)
+                raise
+            await generation_queue.done(job)
+    
+    server = make_http_server()
+    loop_monitor.start()
+    await server.start()
+    
+    async with Bot(BOT_TOKEN, **bot_kwargs) as bot:
+        logger.info(f"Worker started with {concurrency} consumers")
+        consumers = [asyncio.create_task(consume(bot)) for _ in range(concurrency)]
+        mark_boot("ready")
+        try:
+            await stop_event.wait()
+        finally:
+            # Idle consumers stop claiming at once, busy ones get the drain deadline
+            for consumer in consumers:
+                if not inflight_jobs.is_tracked(consumer):
+                    consumer.cancel()
+            await inflight_jobs.drain()
+            await asyncio.gather(*consumers, return_exceptions=True)
+            await outbound.close()
+            await file_id_cache.flush()
+            await close_http_client()
+            shutdown_postprocess_executor()
+            await server.stop()
+            await loop_monitor.stop()
+            logger.info("Worker stopped")
+
+def build_application() -> Application:
+    """Create the application with all handlers and background jobs registered."""
+    from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+    
+    # Process updates concurrently so one slow generation does not hold up
+    # every other chat
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    application = builder.build()
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Persist file_ids learned from uploads
+    application.job_queue.run_repeating(
+        flush_file_id_cache,
+        interval=file_id_cache.flush_interval,
+        first=file_id_cache.flush_interval
+    )
     
-    # Setup commands menu
-    application.job_queue.run_once(
-        lambda context: asyncio.create_task(setup_bot_commands(application)), 
-        when=1
+    # Write settings changes behind the callbacks that make them
+    application.job_queue.run_repeating(
+        flush_settings,
+        interval=settings_store.flush_interval,
+        first=settings_store.flush_interval
     )
     
+    # Prewarm where generations run; the pool lives in process memory
+    if prewarm_pool.enabled and PROCESS_ROLE == "all":
+        application.job_queue.run_repeating(
+            prewarm_images,
+            interval=prewarm_pool.interval,
+            first=prewarm_pool.interval
+        )
+    
     # Add handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("generate", generate_command))
-    application.add_handler(CommandHandler("ping", ping_command))
-    application.add_handler(CallbackQueryHandler(handle_callback_query))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    application.add_handler(CommandHandler("start", timed_handler(start_command)))
+    application.add_handler(CommandHandler("help", timed_handler(help_command)))
+    application.add_handler(CommandHandler("generate", timed_handler(generate_command)))
+    application.add_handler(CommandHandler("ping", timed_handler(ping_command)))
+    application.add_handler(CallbackQueryHandler(timed_handler(handle_callback_query)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(handle_text_message)))
     
     # Add error handler
     application.add_error_handler(error_handler)
     
-    # Start the bot
+    return application
+
+def main():
+    """Main function to run the bot."""
+    mark_boot("imported")
+    logger.info(f"Starting bot with token: {BOT_TOKEN[:10]}...")
+    
+    if PROCESS_ROLE == "worker":
+        logger.info("Starting generation worker...")
+        asyncio.run(run_worker())
+        return
+    
+    application = build_application()
+    
+    if WEBHOOK_CONFIG["url"]:
+        # Webhook mode: one async server handles updates, health checks and metrics
+        logger.info("Starting bot in webhook mode...")
+        asyncio.run(serve_webhook(application))
+        return
+    
+    # Polling mode: the same async server answers health checks and metrics
     logger.info("Starting bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    asyncio.run(serve_polling(application))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()